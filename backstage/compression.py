@@ -0,0 +1,184 @@
+"""
+Response compression for application().
+
+Negotiates gzip or deflate from Accept-Encoding, compresses bodies above
+COMPRESSION_MIN_SIZE, compresses iterable bodies chunk by chunk and keeps
+recently compressed bodies so identical payloads are compressed once.
+"""
+
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+
+import conditional
+
+ENCODINGS = ('gzip', 'deflate')
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml',
+                      '+json', '+xml')
+
+_negotiated = {}
+
+
+def negotiate(accept_encoding):
+    """
+    Returns the preferred encoding from an Accept-Encoding header, None for identity
+    """
+    if not accept_encoding:
+        return None
+    encoding = _negotiated.get(accept_encoding, False)
+    if encoding is not False:
+        return encoding
+
+    qualities = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0
+        qualities[name] = quality
+
+    encoding = None
+    best = 0
+    for name in ENCODINGS:
+        quality = qualities.get(name, qualities.get('*', 0))
+        if quality > best:
+            encoding, best = name, quality
+
+    # Only a handful of distinct headers are sent by clients, keep the table small regardless
+    if len(_negotiated) < 256:
+        _negotiated[accept_encoding] = encoding
+    return encoding
+
+
+def compressor(encoding, level):
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+
+
+def compress(data, encoding, level):
+    compress_object = compressor(encoding, level)
+    return compress_object.compress(data) + compress_object.flush()
+
+
+def compress_stream(chunks, encoding, level):
+    compress_object = compressor(encoding, level)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        data = compress_object.compress(str(chunk))
+        if data:
+            yield data
+    yield compress_object.flush()
+
+
+def precompress(data, level):
+    """
+    Compressed versions of a static body, computed when the XML is loaded
+    """
+    return dict((encoding, compress(data, encoding, level)) for encoding in ENCODINGS)
+
+
+class CompressedBodies(object):
+    """
+    Least recently used compressed bodies keyed by the digest of the body
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.bodies = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, data, encoding, level):
+        key = (hashlib.md5(data).digest(), encoding)
+        with self.lock:
+            compressed = self.bodies.pop(key, None)
+            if compressed is not None:
+                self.bodies[key] = compressed
+                return compressed
+
+        compressed = compress(data, encoding, level)
+        with self.lock:
+            self.bodies[key] = compressed
+            while len(self.bodies) > self.size:
+                self.bodies.popitem(last=False)
+        return compressed
+
+
+_cache = None
+
+
+def is_stream(body):
+    return not isinstance(body, basestring) and hasattr(body, 'next')
+
+
+def is_file(body):
+    return hasattr(body, 'fileno') and hasattr(body, 'read')
+
+
+def is_compressible(content_type):
+    if not content_type:
+        return True
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    return any(content_type.startswith(kind) or content_type.endswith(kind) for kind in COMPRESSIBLE_TYPES)
+
+
+def compress_response(environ, response, headers, body):
+    """
+    Returns the headers and the body to send, compressed when the client accepts it
+    """
+    global _cache
+    from conf.settings import COMPRESSION_ENABLED, COMPRESSION_MIN_SIZE, COMPRESSION_LEVEL, \
+        COMPRESSION_CACHE_SIZE, COMPRESSION_CACHE_MAX_BODY
+
+    # Files are sent as they are so the server can use sendfile()
+    if not COMPRESSION_ENABLED or str(response.status_code) in ('204', '206', '304') or is_file(body):
+        return headers, body
+
+    header_names = dict((name.lower(), value) for name, value in headers)
+    if 'content-encoding' in header_names or not is_compressible(header_names.get('content-type')):
+        return headers, body
+
+    stream = is_stream(body)
+    if not stream and len(body) < COMPRESSION_MIN_SIZE:
+        return headers, body
+
+    # Caches have to keep the compressed and the identity responses apart
+    vary = header_names.get('vary')
+    if not vary:
+        headers = headers + [('Vary', 'Accept-Encoding')]
+    elif 'accept-encoding' not in vary.lower():
+        headers = [header for header in headers if header[0].lower() != 'vary']
+        headers.append(('Vary', '%s, Accept-Encoding' % vary))
+
+    encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING'))
+    if encoding is None:
+        return headers, body
+
+    headers = [(name, conditional.encoded_etag(value, encoding) if name.lower() == 'etag' else value)
+               for name, value in headers if name.lower() != 'content-length']
+    headers.append(('Content-Encoding', encoding))
+
+    if stream:
+        return headers, compress_stream(body, encoding, COMPRESSION_LEVEL)
+
+    precompressed = getattr(response, 'precompressed', None)
+    if precompressed and precompressed[0] is response.message:
+        body = precompressed[1][encoding]
+    elif COMPRESSION_CACHE_SIZE and len(body) <= COMPRESSION_CACHE_MAX_BODY:
+        if _cache is None:
+            _cache = CompressedBodies(COMPRESSION_CACHE_SIZE)
+        body = _cache.get(body, encoding, COMPRESSION_LEVEL)
+    else:
+        body = compress(body, encoding, COMPRESSION_LEVEL)
+
+    headers.append(('Content-Length', str(len(body))))
+    return headers, body
@@ -0,0 +1,200 @@
+"""
+ETag / Last-Modified validators and conditional GET for resources with etag="true".
+
+Static responses get an ETag computed from the body when the XML is loaded, as
+long as nothing else in the sequences can set the body. Views can supply a
+cheap validator through etag() and last_modified() methods. A request whose If-None-Match or If-Modified-Since matches is answered with a
+304 before the sequences run.
+"""
+
+import calendar
+import datetime
+import hashlib
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+import core_exceptions
+
+# Suffixes of the ETags of compressed responses
+ENCODINGS = ('gzip', 'deflate')
+
+
+def sets_body(mediator):
+    """
+    True when a mediator, or one nested in it, can set the body. Only the mediators known to
+    leave the body alone are trusted, switches are checked case by case.
+    """
+    import mediators
+
+    neutral = (mediators.Log, mediators.HttpHeaderMediator, mediators.ProcessResponseMediator,
+               mediators.ValidateMediator, mediators.Payload, mediators.Use, mediators.CallMediator,
+               mediators.TransformMediator, mediators.PDBMediator, mediators.Switch, mediators.Case,
+               mediators.Default)
+    if not isinstance(mediator, neutral):
+        return True
+    return any(sets_body(child) for child in mediator.sequence_list)
+
+
+def static_responses(resource):
+    """
+    The top level static responses of the in and out sequences, None when the body can come
+    from anywhere else ( a view, a template, a property, a response chosen by a switch ... )
+    """
+    from mediators import ResponseMediator
+
+    responses = []
+    for sequence in (resource.in_sequence, resource.out_sequence):
+        for mediator in sequence.sequence_list:
+            if isinstance(mediator, ResponseMediator) and hasattr(mediator, 'value'):
+                responses.append(mediator)
+            elif sets_body(mediator):
+                return None
+    return responses or None
+
+
+def prepare_resource(resource):
+    """
+    Work out, once, where the validators of a resource come from
+    """
+    from mediators import ViewMediator
+
+    resource.static_etag = None
+    responses = static_responses(resource)
+    if responses:
+        digest = hashlib.md5()
+        for response in responses:
+            value = response.value
+            digest.update(value.encode('utf-8') if isinstance(value, unicode) else str(value))
+        resource.static_etag = '"%s"' % digest.hexdigest()
+
+    resource.validator_views = [mediator for mediator in resource.in_sequence.sequence_list
+                                if isinstance(mediator, ViewMediator)]
+
+
+def http_date(value):
+    if value is None or isinstance(value, basestring):
+        return value
+    if isinstance(value, datetime.datetime):
+        value = calendar.timegm(value.utctimetuple())
+    return formatdate(value, usegmt=True)
+
+
+def validators(context, resource):
+    """
+    (etag, last_modified) for the request, either static or from the first view that has them
+    """
+    if resource.static_etag:
+        return resource.static_etag, None
+    if not resource.validator_views:
+        return None, None
+
+    from conf.settings import VIEW_MEDIATOR_HANDLERS
+
+    request = context.request
+    for view_mediator in resource.validator_views:
+        view = VIEW_MEDIATOR_HANDLERS[view_mediator.handler]
+        if not (hasattr(view, 'etag') or hasattr(view, 'last_modified')):
+            continue
+        view_object = view()
+        view_args = getattr(request, 'view_args', [])
+        etag = last_modified = None
+        if hasattr(view_object, 'etag'):
+            etag = view_object.etag(request, *view_args)
+            if etag and not etag.endswith('"'):
+                etag = '"%s"' % etag
+        if hasattr(view_object, 'last_modified'):
+            last_modified = http_date(view_object.last_modified(request, *view_args))
+        return etag, last_modified
+    return None, None
+
+
+def encoded_etag(etag, encoding):
+    """
+    The ETag of the compressed response, a compressed body is a different representation
+    """
+    if etag.endswith('"'):
+        return '%s-%s"' % (etag[:-1], encoding)
+    return etag
+
+
+def strip_tag(tag):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+        tag = tag[2:]
+    for encoding in ENCODINGS:
+        if tag.endswith('-%s"' % encoding):
+            return '%s"' % tag[:-len(encoding) - 2]
+    return tag
+
+
+def etag_matches(if_none_match, etag):
+    if if_none_match.strip() == '*':
+        return True
+    # Weak comparison, W/ prefixes and the encoding suffixes are ignored for GET
+    return strip_tag(etag) in [strip_tag(tag) for tag in if_none_match.split(',')]
+
+
+def is_not_modified(environ, etag, last_modified):
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return bool(etag) and etag_matches(if_none_match, etag)
+
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified:
+        since, modified = parsedate_tz(if_modified_since), parsedate_tz(last_modified)
+        if since and modified:
+            return mktime_tz(modified) <= mktime_tz(since)
+    return False
+
+
+def set_validator_headers(response, etag, last_modified):
+    if etag:
+        response.headers['ETag'] = etag
+    if last_modified:
+        response.headers['Last-Modified'] = last_modified
+
+
+def not_modified(context):
+    """
+    Turn the response into a 304 and stop processing the request
+    """
+    context.response.status_code = 304
+    context.response.status_message = "Not Modified"
+    context.response.message = ''
+    context.response.precompressed = None
+    raise core_exceptions.Raise304Exception()
+
+
+def check(environ, context, resource):
+    """
+    Evaluated before the sequences run, raises Raise304Exception when the client copy is current
+    """
+    if context.request.method not in ('GET', 'HEAD'):
+        return
+    etag, last_modified = validators(context, resource)
+    context.validators = (etag, last_modified)
+    if is_not_modified(environ, etag, last_modified):
+        set_validator_headers(context.response, etag, last_modified)
+        not_modified(context)
+
+
+def finish(environ, context, message):
+    """
+    Add the validators to a response produced by the sequences, the ETag is the hash of the body
+    when neither the XML nor a view gave one. Returns the message to send.
+    """
+    # Only GET and HEAD are answered with a 304, other methods have already made their changes
+    if context.request.method not in ('GET', 'HEAD'):
+        return message
+    etag, last_modified = getattr(context, 'validators', (None, None))
+    response = context.response
+    if str(response.status_code) != '200':
+        return message
+    if not etag and isinstance(message, str):
+        etag = '"%s"' % hashlib.md5(message).hexdigest()
+    set_validator_headers(response, etag, last_modified)
+
+    if is_not_modified(environ, etag, last_modified):
+        response.status_code = 304
+        response.status_message = "Not Modified"
+        return ''
+    return message
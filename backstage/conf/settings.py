@@ -19,6 +19,67 @@ HANDLERS = {
     "pdb": mediators.PDBMediator,
     "view": mediators.ViewMediator,
     "sequence": mediators.NamedSequence,
+    "call": mediators.CallMediator,
+    "transform": mediators.TransformMediator,
+    "file": mediators.FileMediator,
+    "validate": mediators.ValidateMediator,
 }
 
 APPEND_SLASH = True
+
+# Outbound calls made by the call mediator, the pool size is per host and per worker
+CALL_POOL_SIZE = 10
+CALL_IDLE_TIMEOUT = 60
+CALL_CONNECT_TIMEOUT = 5
+CALL_READ_TIMEOUT = 30
+CALL_MAX_RESPONSE_SIZE = 10 * 1024 * 1024
+
+# Admission control, 0 disables a limit. MAX_QUEUE_TIME is in seconds and per API limits
+# are set with max_concurrency on the <api> tag
+MAX_IN_FLIGHT = 0
+MAX_QUEUE_TIME = 0
+# Workers that can be counted at the same time and seconds a worker waits for a counters row
+GOVERNOR_MAX_WORKERS = 64
+GOVERNOR_LOCK_TIMEOUT = 0.5
+
+# Seconds a request may take, 0 means no deadline. The resource or api 'timeout' attribute
+# overrides it and clients can ask for a shorter deadline with the TIMEOUT_HEADER
+DEFAULT_TIMEOUT = 0
+TIMEOUT_HEADER = 'X-Request-Timeout'
+
+# Response compression, bodies smaller than COMPRESSION_MIN_SIZE bytes are sent as they are.
+# Up to COMPRESSION_CACHE_SIZE compressed bodies are kept per worker, 0 disables the cache
+COMPRESSION_ENABLED = True
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+COMPRESSION_CACHE_SIZE = 256
+COMPRESSION_CACHE_MAX_BODY = 1024 * 1024
+
+# Traffic recording, add backstage.recording.RecordingProcessor to REQUEST_PROCESSORS to use it.
+# Every worker writes its own log in RECORD_DIRECTORY, rotated once it reaches RECORD_MAX_BYTES
+RECORD_DIRECTORY = 'recordings'
+RECORD_SAMPLE_RATE = 1.0
+RECORD_MAX_BYTES = 64 * 1024 * 1024
+RECORD_BACKUP_COUNT = 5
+RECORD_QUEUE_SIZE = 10000
+# Request headers whose values are replaced before a request is recorded
+RECORD_REDACT_HEADERS = ['Authorization', 'Cookie', 'Proxy-Authorization']
+
+# At most FAULT_TRACEBACK_LIMIT tracebacks are logged every FAULT_TRACEBACK_INTERVAL seconds,
+# out of a FAULT_TRACEBACK_SAMPLE_RATE sample of the server errors
+FAULT_TRACEBACK_LIMIT = 10
+FAULT_TRACEBACK_INTERVAL = 60
+FAULT_TRACEBACK_SAMPLE_RATE = 1.0
+
+# Memory accounting per API, resource and mediator, off by default since every mediator is measured.
+# Summaries are logged every MEMORY_SUMMARY_INTERVAL seconds and served at MEMORY_DEBUG_URL ( None
+# disables it ), a worker whose RSS goes over MEMORY_MAX_RSS megabytes is recycled, 0 never
+MEMORY_ACCOUNTING = False
+MEMORY_SUMMARY_INTERVAL = 300
+MEMORY_DEBUG_URL = None
+MEMORY_MAX_RSS = 0
+MEMORY_TOP = 10
+
+# Stat results of the files sent by the file mediator are kept for FILE_CACHE_TTL seconds
+FILE_CACHE_SIZE = 1024
+FILE_CACHE_TTL = 2
@@ -10,11 +10,19 @@ __license__ = 'APACHE 2.0'
 
 """
 
+import json
 import logging
 import os
 import re
+import sys
+import time
 from urllib import unquote as urlunquote
+import compression
+import conditional
 import core_exceptions
+import expressions
+import faults
+import files
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('backstage')
@@ -27,8 +35,16 @@ class Mediator(object):
     def mediate(self):
         raise Exception("This needs to be implemented by a subclass")
 
+    def prepare(self):
+        """
+        Called once the XML attributes and the child mediators are set, mediators
+        compile whatever they can here instead of on every request.
+        """
+        pass
+
     def run_internal_sequences(self, context):
         for sequence in self.sequence_list:
+            context.check_deadline()
             sequence.mediate(context)
 
 
@@ -79,6 +95,8 @@ class RequestHeader(dict):
 
 
 class Request(object):
+    deadline = None
+
     def __init__(self, environ):
         self.headers = RequestHeader(environ)
         self.method = self.headers.raw("REQUEST_METHOD")
@@ -87,13 +105,76 @@ class Request(object):
             self.query_string = self.headers.raw("QUERY_STRING")
         elif self.method == "POST" or self.method == "PUT" or self.method == 'PATCH':
             self.input = self.headers.raw("wsgi.input")
-            self.content_length = int(self.headers.raw("CONTENT_LENGTH"))
-            self.body = self.input.read(self.content_length)
+            self.content_length = int(self.headers.raw("CONTENT_LENGTH") or 0)
             self.query_string = self.headers.raw("QUERY_STRING")
 
         self.url_path = self.headers.raw("PATH_INFO")
         self.content_type = self.headers.raw("CONTENT_TYPE")
 
+    @property
+    def body(self):
+        """
+        The raw body, read from the input the first time it is used
+        """
+        if '_body' not in self.__dict__:
+            if hasattr(self, 'input'):
+                self._body = self.input.read(self.content_length)
+            else:
+                self._body = ''
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+        self.__dict__.pop('_data', None)
+
+    @property
+    def data(self):
+        """
+        The body parsed according to the content type, parsed the first time it is used.
+        JSON bodies are decoded, form and multipart bodies are returned as a dictionary.
+        Multipart bodies are streamed from the input so uploaded files do not end up in memory.
+        """
+        if '_data' not in self.__dict__:
+            self._data = self.parse_body()
+        return self._data
+
+    def parse_body(self):
+        media_type = self.content_type.split(";", 1)[0].strip().lower()
+
+        if media_type == 'application/json' or media_type.endswith('+json'):
+            if not self.body:
+                return None
+            try:
+                return json.loads(self.body)
+            except ValueError, e:
+                raise core_exceptions.Raise400Exception("Invalid JSON body: %s" % e)
+
+        if media_type == 'application/x-www-form-urlencoded':
+            return dict(_parse_qsl(self.body))
+
+        if media_type == 'multipart/form-data':
+            import cgi
+            from StringIO import StringIO
+
+            # Stream from the input unless somebody already read the body
+            fp = StringIO(self._body) if '_body' in self.__dict__ else getattr(self, 'input', None)
+            if fp is None:
+                return {}
+            environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': self.content_type,
+                       'CONTENT_LENGTH': str(self.content_length)}
+            form = cgi.FieldStorage(fp=fp, environ=environ, keep_blank_values=True)
+            # Files are kept as FieldStorage objects, everything else as strings. A name sent
+            # more than once ( checkboxes, several files ) gets a list
+            data = {}
+            for key in form.keys():
+                fields = form[key] if isinstance(form[key], list) else [form[key]]
+                values = [field if field.filename else field.value for field in fields]
+                data[key] = values if len(values) > 1 else values[0]
+            return data
+
+        return None
+
     def __str__(self):
         if self.method == "GET":
             return "Method-%s;Query String - %s;URL -%s" % (self.method, self.query_string, self.url_path)
@@ -106,7 +187,9 @@ class Request(object):
         """
         Return all the query parameters in a dictionary 
         """
-        return dict(_parse_qsl(self.query_string))
+        if '_GET' not in self.__dict__:
+            self._GET = dict(_parse_qsl(getattr(self, 'query_string', '')))
+        return self._GET
 
 
 class Response(object):
@@ -116,6 +199,8 @@ class Response(object):
         self.status_code = status_code
         self.status_message = status_message
         self.message = body
+        # ( message, {encoding: compressed message} ) for bodies compressed ahead of time
+        self.precompressed = None
 
     def set_headers(self, headers):
         for header, value in headers.iteritems():
@@ -125,6 +210,24 @@ class Context(object):
     def __init__(self, request, response):
         self.request = request
         self.response = response
+        self.deadline = None
+
+    def set_timeout(self, timeout):
+        """
+        Start the deadline for the request, it is passed on to the views through the request
+        """
+        if timeout:
+            self.deadline = time.time() + timeout
+        self.request.deadline = self.deadline
+
+    def time_remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def check_deadline(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            raise core_exceptions.Raise504Exception("Deadline exceeded for %s " % self.request.url_path)
 
     def add_to_context(self, name, key, value):
         registry_value = getattr(self, name)
@@ -135,12 +238,8 @@ class Context(object):
         payload_key, payload_value = payload.split(".")
 
         if payload_key == "context" and payload_value == "query_string":
-            # Convert Query Strings to a dict
-            query_parameters = {}
-            for query_params in self.request.query_string.split(","):
-                key, value = query_params.split("=")
-                query_parameters[key] = value
-            return query_parameters
+            # Query Strings as a dict
+            return self.request.GET
 
         if payload_key == 'context':
             return getattr(self, payload_value)
@@ -151,6 +250,12 @@ class Context(object):
         else:
             return getattr(message, payload_value)
 
+    def evaluate(self, expression):
+        """
+        Value of a $context, $request, $response, $header or $body expression
+        """
+        return expressions.compile_expression(expression)(self)
+
     def from_request(self, key):
         return getattr(self.request, key, "")
 
@@ -200,6 +305,17 @@ class APIS(object):
         """
         Returns the appropriate sequence that matches the URI based on the services.xml
         """
+        resource = self.resource_for_uri(request)
+        if resource is None:
+            raise Exception(
+                "The sequence type sent '%s' is not supported for the URI '%s' " % (sequence_type, request.url_path))
+        return getattr(resource, ("%s_sequence" % sequence_type))
+
+    @classmethod
+    def resource_for_uri(self, request):
+        """
+        Returns the resource that matches the URI and the method, None if there is none
+        """
         url_path = request.url_path.lstrip("/")
 
         # TODO: This method has to be changed once the uri matching is done fine
@@ -219,11 +335,9 @@ class APIS(object):
                         
                     logger.info(
                         "Sequence returning for %s method, %s url path " % (resource.method, request.url_path))
-                    return getattr(resource, ("%s_sequence" % sequence_type))
+                    return resource
 
-        # If none of the methods match raise exception
-        raise Exception(
-            "The sequence type sent '%s' is not supported for the URI '%s' " % (sequence_type, request.url_path))  
+        return None
 
 
 class API(object):
@@ -251,6 +365,24 @@ def _parse_qsl(qs):
     return r
 
 
+def request_timeout(request, api, resource):
+    """
+    Seconds the request is allowed to take, from the resource, the api or the settings.
+    A client can ask for a shorter deadline with the timeout header.
+    """
+    from conf.settings import DEFAULT_TIMEOUT, TIMEOUT_HEADER
+
+    timeout = float(getattr(resource, 'timeout', None) or getattr(api, 'timeout', None) or DEFAULT_TIMEOUT or 0)
+    if TIMEOUT_HEADER and TIMEOUT_HEADER in request.headers:
+        try:
+            client_timeout = float(request.headers[TIMEOUT_HEADER])
+        except ValueError:
+            client_timeout = 0
+        if client_timeout > 0 and (not timeout or client_timeout < timeout):
+            timeout = client_timeout
+    return timeout
+
+
 # TODO: Check if this is required and remove from code since we are handling views more
 # sanely now
 class View(object):
@@ -283,6 +415,15 @@ class Resource(object):
         self.in_sequence = InSequence()
         self.out_sequence = OutSequence()
         self.fault_sequence = FaultSequence()
+        self.etag = False
+
+    def prepare(self):
+        """
+        Called once the sequences of the resource are parsed
+        """
+        self.etag = self.etag in (True, 'true')
+        if self.etag:
+            conditional.prepare_resource(self)
 
     def __str__(self):
         return "Method: %s" % (self.method)
@@ -292,16 +433,16 @@ class Resource(object):
 def application(environ, start_response):
     request = Request(environ)
 
+    from memory import accounting
+    if accounting.debug_url and request.url_path == accounting.debug_url:
+        return accounting.respond(start_response)
+
     # Match URI's from APIS because that is where we register everything
     try:
         APIS.match_url(request)
     except core_exceptions.Raise404Exception, e:
         # Send a 404 back to the user
-        status = str("404 Not Found")  # HTTP Status
-        message = e
-        headers = [(str("Content-type"), str("text/plain"))]  # HTTP Headers
-        start_response(status, headers)
-        return message
+        return faults.respond(start_response, e)
 
     # If requested method is OPTIONS then set the CORS ( Cross origin resource sharing ) responses
     if request.method == 'OPTIONS':
@@ -321,64 +462,114 @@ def application(environ, start_response):
         api = APIS.match_method(request)
     except core_exceptions.Raise405Exception, e:
         # Send a 405 back to the user
-        status = str("405 Method Not Supported")  # HTTP Status
-        message = e
-        headers = [(str("Content-type"), str("text/plain"))]  # HTTP Headers
-        start_response(status, headers)
         logger.info("Sending response ")
-        return message
+        return faults.respond(start_response, e)
 
+    # Shed load before any work is done for the request
+    from governor import governor
     try:
-        # Parse the XML element and run this in sequence
-        # Initialise a context object with request which can be shared across
-        context = Context(request, Response())
+        governor.admit(environ, api)
+    except core_exceptions.Raise503Exception, e:
+        return faults.respond(start_response, e, [("Retry-After", "1")])
+
+    # Parse the XML element and run this in sequence
+    # Initialise a context object with request which can be shared across
+    context = Context(request, Response())
+    resource = None
+    memory_start = accounting.start()
 
+    try:
         # Add the api object to the context object
         setattr(context, '_api_object', api)
+        request.api = api
+
+        # Resolved first so a pre processor that raises still gets the resource's fault sequence
+        resource = APIS.resource_for_uri(request)
 
         # Run all the Pre Processors here
         from conf.settings import REQUEST_PROCESSORS
         for processor in REQUEST_PROCESSORS:
             processor().pre_process(request)
 
-        # Run the insequence first
-        sequence_to_be_followed = APIS.sequence_for_uri(request, "in")
-
-        for sequence in sequence_to_be_followed.sequence_list:
-            logging.info("Sequence being called %s " % sequence.__class__.__name__)
-            if hasattr(context, 'break_sequence') and context.break_sequence:
-                logging.info("Encountered a break request so breaking off !!")
-                break
-            else:
+        if resource is None:
+            raise core_exceptions.Raise404Exception("URI %s not found in defined API's" % request.url_path)
+        context.set_timeout(request_timeout(request, api, resource))
+
+        # Answer conditional GETs with a 304 before any sequence runs
+        if resource.etag:
+            conditional.check(environ, context, resource)
+
+        try:
+            # Run the insequence first
+            sequence_to_be_followed = resource.in_sequence
+
+            for sequence in sequence_to_be_followed.sequence_list:
+                context.check_deadline()
+                logging.info("Sequence being called %s " % sequence.__class__.__name__)
+                if hasattr(context, 'break_sequence') and context.break_sequence:
+                    logging.info("Encountered a break request so breaking off !!")
+                    break
+                else:
+                    sequence.mediate(context)
+        except core_exceptions.RunOutSequence, e:
+            # Run the outSequence
+            out_sequence_to_be_followed = resource.out_sequence
+            # Parse the XML element and run this in sequence
+            for sequence in out_sequence_to_be_followed.sequence_list:
+                context.check_deadline()
+                logging.info("Out Sequence being called %s " % sequence.__class__.__name__)
                 sequence.mediate(context)
-    except core_exceptions.RunOutSequence, e:
-        # Run the outSequence
-        out_sequence_to_be_followed = APIS.sequence_for_uri(context.request, "out")
-        # Parse the XML element and run this in sequence
-        for sequence in out_sequence_to_be_followed.sequence_list:
-            logging.info("Out Sequence being called %s " % sequence.__class__.__name__)
-            sequence.mediate(context)
+    except core_exceptions.Raise304Exception:
+        logger.info("Not modified, skipping the sequences for %s " % request.url_path)
+    except core_exceptions.RequestInvalidException:
+        # The validate mediator already set the 400 response
+        pass
     except Exception, e:
         # Any exception occurs during the process run the fault sequence
-        import traceback
-        print traceback.format_exc()
-
-        fault_sequence_to_be_followed = APIS.sequence_for_uri(request, "fault")
-        for sequence in fault_sequence_to_be_followed.sequence_list:
-            sequence.mediate(context)
-
-            # TODO: Return the fault message from here
-            # TODO: If the inbuilt exception is an HTTP exception generated from somewhere
-            #      that has to be handled separately. Any unknown exception has to be
-            #      returned as a 500
+        # A request that ran out of time is answered with a 504 whatever the exception was
+        if context.time_remaining() is not None and context.time_remaining() <= 0:
+            fault = faults.fault_for(core_exceptions.Raise504Exception())
+        else:
+            fault = faults.fault_for(e)
+        if fault.status_code >= 500:
+            faults.sampler.capture(sys.exc_info(), request.url_path)
+
+        # The fault sequence starts from the mapped response and can change it
+        context.response = Response(body=fault.message(e), status_code=fault.status_code,
+                                    status_message=fault.status_message)
+        context.response.set_headers(dict(fault.headers))
+
+        if resource is not None:
+            try:
+                for sequence in resource.fault_sequence.sequence_list:
+                    sequence.mediate(context)
+            except Exception:
+                faults.sampler.capture(sys.exc_info(), request.url_path)
     finally:
+        governor.release(environ, api)
+
         # Run all the Post Processors here
         from conf.settings import REQUEST_PROCESSORS
         for processor in REQUEST_PROCESSORS:
             processor().post_process(request)
 
+        accounting.finish(environ, context, api, resource, memory_start)
+
         if not context.response.status_code:
-            raise Exception("No status code set in the response !!")
+            logger.error("No status code set in the response for %s !!" % request.url_path)
+            fault = faults.INTERNAL_SERVER_ERROR
+            context.response = Response(body=fault.body, status_code=fault.status_code,
+                                        status_message=fault.status_message)
+            context.response.set_headers(dict(fault.headers))
+
+        message = context.response.message
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        elif not (compression.is_stream(message) or compression.is_file(message)):
+            message = str(message)
+
+        if resource is not None and resource.etag:
+            message = conditional.finish(environ, context, message)
 
         status = "%s %s" % (context.response.status_code, context.response.status_message)
 
@@ -386,56 +577,65 @@ def application(environ, start_response):
         for header_name, header_value in context.response.headers.iteritems():
             headers.append((str(header_name), str(header_value)))
 
-        message = str(context.response.message)
+        headers, message = compression.compress_response(environ, context.response, headers, message)
 
         start_response(status, headers)
-        return iter([message])
+        if isinstance(message, str):
+            return iter([message])
+        if compression.is_file(message):
+            return files.wrap(environ, message)
+        return message
+
+
+def build_handler(element, base_dir):
+    """
+    Create the mediator for an XML element along with all its child mediators
+    """
+    from conf.settings import HANDLERS
+
+    Handler = HANDLERS.get(element.tag)
+    if Handler is None:
+        raise Exception("Handler for %s is not defined " % element.tag)
+    handler = Handler()
+    for item in element.items():
+        setattr(handler, item[0], item[1])
+    handler._base_dir = base_dir
+    for child in element.getchildren():
+        # Skip XML comments and processing instructions
+        if not isinstance(child.tag, basestring):
+            continue
+        handler.sequence_list.append(build_handler(child, base_dir))
+    handler.prepare()
+    return handler
+
+
+def build_sequence(element, sequence, base_dir):
+    if element is None:
+        return
+    for child in element.getchildren():
+        if not isinstance(child.tag, basestring):
+            continue
+        sequence.sequence_list.append(build_handler(child, base_dir))
 
 
 def parse_services_xml(file_name, api):
     # Read services directory from the settings file
-    from conf.settings import HANDLERS
     from mediators import NamedSequences
 
     from lxml import etree
     apis_tree = etree.parse(file_name)
+    base_dir = os.path.dirname(os.path.abspath(file_name))
 
     # The root of the tree could containg either a sequence or apis, sequence is stored as
     # a dict in the api object
-
-    def create_handler(element):
-        Handler = HANDLERS.get(element.tag)
-        if not Handler:
-            print "%s does not have a proper handler defined " % element.tag
-        handler = Handler()
-        for item in element.items():
-            setattr(handler, item[0], item[1])
-        return handler
-
-    def parse_children(element, main_handler):
-        for el in element.getchildren():
-            handler = create_handler(el)
-            main_handler.sequence_list.append(handler)
-            parse_children(el, handler)
     if apis_tree.getroot().tag == 'sequence':
-        # named_resource = NamedResource()
         sequence_element = apis_tree.getroot()
         sequence_name = sequence_element.get('name')
-        sequence_dict = {sequence_name: []}
         sequence_list = []
         for element in sequence_element.getchildren():
-            Handler = HANDLERS.get(element.tag)
-            if Handler is None:
-                raise Exception("Handler for %s is not defined " % element.tag)
-            main_handler = Handler()
-            for ii in element.items():
-                setattr(main_handler, ii[0], ii[1])
-            sequence_list.append(main_handler)
-            parse_children(element, main_handler)
-        sequence_dict[sequence_name] = sequence_list
-        # named_resource.sequence = sequence_list
-        # api.sequences.update(sequence_dict)
-        # APIS.sequences[sequence_name] = sequence_list
+            if not isinstance(element.tag, basestring):
+                continue
+            sequence_list.append(build_handler(element, base_dir))
         NamedSequences.sequences[sequence_name] = sequence_list
 
     # tree should contain a list of all the apis
@@ -455,57 +655,10 @@ def parse_services_xml(file_name, api):
             # Add supported methods to the API and not to resource
             api.supported_methods.append(resource.method)
 
-            def create_handler(element):
-                Handler = HANDLERS.get(element.tag)
-                if not Handler:
-                    print "%s does not have a proper handler defined " % element.tag
-                handler = Handler()
-                for item in element.items():
-                    setattr(handler, item[0], item[1])
-                return handler
-
-            def parse_children(element, main_handler):
-                for el in element.getchildren():
-                    handler = create_handler(el)
-                    main_handler.sequence_list.append(handler)
-                    parse_children(el, handler)
-
-            for element in internal_resources.find("inSequence"):
-                Handler = HANDLERS.get(element.tag)
-                if Handler is None:
-                    raise Exception("Handler for %s is not defined " % element.tag)
-                main_handler = Handler()
-                for ii in element.items():
-                    setattr(main_handler, ii[0], ii[1])
-                resource.in_sequence.sequence_list.append(main_handler)
-                parse_children(element, main_handler)
-
-            if internal_resources.find("outSequence"):
-                # Parse all the OutSequences
-                for element in internal_resources.find("outSequence"):
-                    Handler = HANDLERS.get(element.tag)
-                    if Handler is None:
-                        raise Exception("Handler for %s is not defined " % element.tag)
-                    handler = Handler()
-                    for ii in element.items():
-                        setattr(handler, ii[0], ii[1])
-                    resource.out_sequence.sequence_list.append(handler)
-                    parse_children(element, handler)
-
-            if internal_resources.find("faultSequence"):
-                # Parse all the FaultSequences
-                for element in internal_resources.find("faultSequence"):
-                    Handler = HANDLERS.get(element.tag)
-                handler = Handler()
-                for ii in element.items():
-                    setattr(handler, ii[0], ii[1])
-                resource.fault_sequence.sequence_list.append(handler)
-                for ll in element.getchildren():
-                    Handler = HANDLERS.get(ll.tag)
-                    handler = Handler()
-                    for ii in ll.items():
-                        setattr(handler, ii[0], ii[1])
-                    handler.sequence_list.append(handler)
+            build_sequence(internal_resources.find("inSequence"), resource.in_sequence, base_dir)
+            build_sequence(internal_resources.find("outSequence"), resource.out_sequence, base_dir)
+            build_sequence(internal_resources.find("faultSequence"), resource.fault_sequence, base_dir)
+            resource.prepare()
 
     for api in APIS.apis:
         APIS.urls_and_apis[api.context] = api
@@ -540,15 +693,25 @@ def parse_services_xml(file_name, api):
 
 
 def run():
-    import sys
     # Work directory contains all the apps that we would be working with    
-    file_names = sys.argv[2]
+    load(sys.argv[2])
+
 
+def load(file_names):
+    """
+    Parse a comma separated list of XML files or directories of XML files
+    """
     for file_name in file_names.split(","):
         sys.path.append(file_name)
 
     api = API()
 
+    # Loading again replaces what was loaded before instead of adding to it
+    from mediators import NamedSequences
+    del APIS.apis[:]
+    APIS.urls_and_apis.clear()
+    NamedSequences.sequences.clear()
+
     # Check if file_name is a file or a directory. If a directory is passed
     # then all the xml's in the directory have to be parsed.
     for file_name in file_names.split(","):
@@ -565,6 +728,13 @@ def run():
             logger.info("Parsing services xml %s" % file_name)
             parse_services_xml(file_name, api)
 
+    # Allocate the admission control counters before any worker is forked
+    from governor import governor
+    governor.setup(APIS.apis)
+
+    from memory import accounting
+    accounting.setup(APIS.apis)
+
     # Clear resources cache
     #clear_cache_resources()
 
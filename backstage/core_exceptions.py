@@ -2,6 +2,12 @@
 All the exceptions for backstage go here !!
 """
 
+class Raise304Exception(Exception):
+    pass
+
+class Raise400Exception(Exception):
+    pass
+
 class Raise404Exception(Exception):
     pass
 
@@ -14,6 +20,12 @@ class Raise429Exception(Exception):
 class Raise401Exception(Exception):
     pass
 
+class Raise503Exception(Exception):
+    pass
+
+class Raise504Exception(Exception):
+    pass
+
 class InvalidGrantTypeException(Exception):
     pass
 
@@ -23,6 +35,12 @@ class RunOutSequence(Exception):
 class RunNamedSequence(Exception):
     pass
 
+class RequestInvalidException(Exception):
+    """
+    Raised once the validate mediator has set the 400 response, ends the request wherever it was raised
+    """
+    pass
+
 class InvalidGrantTypeException(Exception):
     pass
 
@@ -31,3 +49,15 @@ class TokenRevocationException(Exception):
 
 class IncorrectAuthorizationCodeException(Exception):
     pass
+
+class CallException(Exception):
+    pass
+
+class CallTimeoutException(CallException):
+    pass
+
+class PoolExhaustedException(CallException):
+    pass
+
+class ResponseTooLargeException(CallException):
+    pass
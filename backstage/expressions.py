@@ -0,0 +1,174 @@
+"""
+Compiled $context, $request, $response, $header and $body expressions.
+
+Mediators compile their expressions once when the XML is parsed and only run
+the resulting accessors while mediating a request.
+"""
+
+import json
+import re
+import urllib
+
+PLACEHOLDER = re.compile(r'\{(\$[A-Za-z_][\w.\-]*)\}')
+
+_expressions = {}
+_templates = {}
+
+
+def _lookup(obj, name):
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    if isinstance(obj, (list, tuple)) and name.isdigit():
+        index = int(name)
+        return obj[index] if index < len(obj) else None
+    return getattr(obj, name, None)
+
+
+def _walk(path):
+    if not path:
+        return lambda obj: obj
+
+    def walk(obj):
+        for name in path:
+            obj = _lookup(obj, name)
+        return obj
+    return walk
+
+
+def _header(name):
+    def header(context):
+        headers = context.request.headers
+        if name in headers:
+            return headers[name]
+        return None
+    return header
+
+
+def compile_expression(expression):
+    """
+    Compile an expression such as $context.payload.name, $body.user.id or $header.authorization
+    into a function of the context. Values not starting with $ are literals.
+    """
+    accessor = _expressions.get(expression)
+    if accessor is not None:
+        return accessor
+
+    if not expression.startswith('$'):
+        accessor = lambda context: expression
+    else:
+        parts = expression[1:].split('.')
+        root, path = parts[0], parts[1:]
+        walk = _walk(path)
+        if root == 'context':
+            accessor = lambda context: walk(context)
+        elif root == 'request':
+            accessor = lambda context: walk(context.request)
+        elif root == 'response':
+            accessor = lambda context: walk(context.response)
+        elif root == 'body':
+            # The parsed body, the request only parses it the first time it is used
+            accessor = lambda context: walk(context.request.data)
+        elif root == 'header':
+            if not path:
+                raise Exception("Expression %s does not name a header " % expression)
+            header = _header(path[0])
+            rest = _walk(path[1:])
+            accessor = lambda context: rest(header(context))
+        else:
+            raise Exception("Unknown expression $%s " % root)
+
+    _expressions[expression] = accessor
+    return accessor
+
+
+def _to_bytes(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def _to_string(value):
+    """
+    Rendered values are UTF-8 bytes, decoded JSON bodies and non ASCII attributes are unicode
+    """
+    if value is None:
+        return ''
+    if isinstance(value, basestring):
+        return _to_bytes(value)
+    return str(value)
+
+
+def _to_json(value):
+    """
+    Strings are escaped to sit inside quotes in the template, anything else is written as JSON
+    """
+    if isinstance(value, basestring):
+        return json.dumps(value)[1:-1]
+    return json.dumps(value)
+
+
+def _to_url(value):
+    """
+    Values substituted in a URL are percent-encoded, they cannot add path segments or a query
+    """
+    return urllib.quote(_to_string(value), safe='')
+
+
+ESCAPES = {None: _to_string, 'json': _to_json, 'url': _to_url}
+
+
+class Template(object):
+    """
+    A string with {$expression} placeholders, split once into literal segments
+    and accessors so rendering is a single join.
+    """
+
+    def __init__(self, text, escape=None):
+        self.text = text
+        self.segments = []
+        convert = ESCAPES[escape]
+        position = 0
+        for match in PLACEHOLDER.finditer(text):
+            if match.start() > position:
+                self.segments.append(_to_bytes(text[position:match.start()]))
+            accessor = compile_expression(match.group(1))
+            self.segments.append(lambda context, accessor=accessor: convert(accessor(context)))
+            position = match.end()
+        if position < len(text):
+            self.segments.append(_to_bytes(text[position:]))
+
+    def is_static(self):
+        return all(isinstance(segment, basestring) for segment in self.segments)
+
+    def render(self, context):
+        return ''.join([segment if isinstance(segment, basestring) else segment(context)
+                        for segment in self.segments])
+
+    def iter_render(self, context):
+        """
+        Render segment by segment, for large templates that are streamed to the client
+        """
+        for segment in self.segments:
+            yield segment if isinstance(segment, basestring) else segment(context)
+
+
+def compile_template(text, escape=None):
+    template = _templates.get((text, escape))
+    if template is None:
+        template = _templates[(text, escape)] = Template(text, escape)
+    return template
+
+
+def compile_value(text, escape=None):
+    """
+    Compile an attribute value that is either a whole expression ($context.body),
+    which keeps the type of the value, or a string with {$expression} placeholders.
+    """
+    if text.startswith('$'):
+        return compile_expression(text)
+    template = compile_template(text, escape)
+    if template.is_static():
+        return lambda context: text
+    return template.render
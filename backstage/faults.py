@@ -0,0 +1,122 @@
+"""
+Fault handling for application().
+
+Exceptions are mapped to HTTP statuses through a registry whose response
+bodies are built once, and tracebacks reach the logging pipeline sampled and
+rate limited so that an error storm is not slowed down by formatting them.
+"""
+
+import logging
+import random
+import threading
+import time
+
+import core_exceptions
+
+logger = logging.getLogger('backstage')
+
+
+class Fault(object):
+    def __init__(self, status_code, status_message, body=None, expose_message=False):
+        self.status_code = status_code
+        self.status_message = status_message
+        self.status = "%s %s" % (status_code, status_message)
+        self.body = status_message if body is None else body
+        # HTTP exceptions raised on purpose can carry the message sent to the client
+        self.expose_message = expose_message
+        self.headers = [("Content-type", "text/plain")]
+
+    def message(self, exception):
+        if self.expose_message and exception.args:
+            return str(exception)
+        return self.body
+
+
+INTERNAL_SERVER_ERROR = Fault(500, "Internal Server Error")
+
+_registry = {}
+_resolved = {}
+
+
+def register(exception_class, status_code, status_message, body=None, expose_message=False):
+    """
+    Map an exception class, and its subclasses, to a status code and a response body
+    """
+    _registry[exception_class] = Fault(status_code, status_message, body, expose_message)
+    _resolved.clear()
+
+
+def fault_for(exception):
+    exception_class = type(exception)
+    fault = _resolved.get(exception_class)
+    if fault is None:
+        fault = INTERNAL_SERVER_ERROR
+        for klass in exception_class.__mro__:
+            if klass in _registry:
+                fault = _registry[klass]
+                break
+        _resolved[exception_class] = fault
+    return fault
+
+
+def respond(start_response, exception, extra_headers=()):
+    """
+    Answer the request straight from the registry, for faults that happen before any sequence runs
+    """
+    fault = fault_for(exception)
+    start_response(fault.status, fault.headers + list(extra_headers))
+    return iter([fault.message(exception)])
+
+
+register(core_exceptions.Raise400Exception, 400, "Bad Request", expose_message=True)
+register(core_exceptions.Raise401Exception, 401, "Unauthorized", expose_message=True)
+register(core_exceptions.Raise404Exception, 404, "Not Found", expose_message=True)
+register(core_exceptions.Raise405Exception, 405, "Method Not Supported", expose_message=True)
+register(core_exceptions.Raise429Exception, 429, "Too Many Requests", expose_message=True)
+register(core_exceptions.Raise503Exception, 503, "Service Unavailable", expose_message=True)
+register(core_exceptions.Raise504Exception, 504, "Gateway Timeout")
+register(core_exceptions.InvalidGrantTypeException, 400, "Bad Request")
+register(core_exceptions.IncorrectAuthorizationCodeException, 400, "Bad Request")
+register(core_exceptions.CallException, 502, "Bad Gateway")
+register(core_exceptions.ResponseTooLargeException, 502, "Bad Gateway")
+register(core_exceptions.CallTimeoutException, 504, "Gateway Timeout")
+register(core_exceptions.PoolExhaustedException, 503, "Service Unavailable")
+
+
+class TracebackSampler(object):
+    """
+    Logs at most `limit` tracebacks every `interval` seconds, of a `sample_rate` sample of the errors
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.window_started = 0
+        self.logged = 0
+        self.suppressed = 0
+
+    def capture(self, exc_info, url_path):
+        from conf.settings import FAULT_TRACEBACK_LIMIT, FAULT_TRACEBACK_INTERVAL, FAULT_TRACEBACK_SAMPLE_RATE
+
+        if FAULT_TRACEBACK_SAMPLE_RATE < 1 and random.random() >= FAULT_TRACEBACK_SAMPLE_RATE:
+            self.suppressed += 1
+            return
+
+        with self.lock:
+            now = time.time()
+            if now - self.window_started >= FAULT_TRACEBACK_INTERVAL:
+                self.window_started = now
+                self.logged = 0
+            if self.logged >= FAULT_TRACEBACK_LIMIT:
+                self.suppressed += 1
+                return
+            self.logged += 1
+            suppressed, self.suppressed = self.suppressed, 0
+
+        if suppressed:
+            logger.error("Error while processing %s ( %s earlier tracebacks were not logged )" % (
+                url_path, suppressed), exc_info=exc_info)
+        else:
+            logger.error("Error while processing %s" % url_path, exc_info=exc_info)
+
+
+sampler = TracebackSampler()
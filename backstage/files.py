@@ -0,0 +1,194 @@
+"""
+Static files for the file mediator.
+
+Paths are resolved under a root directory and their stat results are cached
+for FILE_CACHE_TTL seconds, so conditional requests are answered without
+touching the disk. Bodies are handed to the server's wsgi.file_wrapper, which
+can send them with sendfile() instead of reading them into Python strings.
+
+Every request opens its own descriptor. A descriptor shared between requests,
+even a dup() of it, shares the file offset, so concurrent requests would move
+each other's position before the server sends the file.
+"""
+
+import mimetypes
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+from wsgiref.util import FileWrapper
+
+import conditional
+
+BLOCK_SIZE = 64 * 1024
+
+
+class FileInfo(object):
+    __slots__ = ('path', 'size', 'mtime', 'etag', 'last_modified', 'content_type', 'checked')
+
+    def __init__(self, path, stat_result):
+        self.path = path
+        self.size = stat_result.st_size
+        self.mtime = stat_result.st_mtime
+        self.etag = '"%x-%x-%x"' % (stat_result.st_ino, self.size, int(self.mtime * 1000000))
+        self.last_modified = conditional.http_date(int(self.mtime))
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.checked = time.time()
+
+    def matches(self, stat_result):
+        return stat_result.st_size == self.size and stat_result.st_mtime == self.mtime
+
+
+class FileCache(object):
+    """
+    Least recently used FileInfo of resolved paths, keyed by the root and the requested path
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            info = self.files.pop(key, None)
+            if info is not None and time.time() - info.checked < self.ttl:
+                self.files[key] = info
+                return info
+        return None
+
+    def put(self, key, info):
+        with self.lock:
+            self.files[key] = info
+            while len(self.files) > self.size:
+                self.files.popitem(last=False)
+
+
+_cache = None
+
+
+def file_cache():
+    global _cache
+    if _cache is None:
+        from conf.settings import FILE_CACHE_SIZE, FILE_CACHE_TTL
+        _cache = FileCache(FILE_CACHE_SIZE, FILE_CACHE_TTL)
+    return _cache
+
+
+def resolve(root, name):
+    """
+    FileInfo of a regular file under root, None when there is no such file or it is outside the root
+    """
+    if not name or '\0' in name:
+        return None
+    cache = file_cache()
+    key = (root, name)
+    info = cache.get(key)
+    if info is not None:
+        return info
+
+    # Symbolic links are followed, the file they point to has to be under the root as well
+    path = os.path.realpath(os.path.join(root, name.lstrip('/')))
+    if not path.startswith(root.rstrip(os.sep) + os.sep):
+        return None
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(stat_result.st_mode):
+        return None
+
+    info = FileInfo(path, stat_result)
+    cache.put(key, info)
+    return info
+
+
+def parse_range(header, size):
+    """
+    (start, end) of a single byte range, end included. None when the header is not a single
+    byte range, which is answered with the whole file, and False when it cannot be satisfied.
+    """
+    unit, _, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, dash, last = ranges.strip().partition('-')
+    if not dash:
+        return None
+    try:
+        if not first:
+            # The last N bytes
+            length = int(last)
+            if length <= 0 or not size:
+                return False
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def if_range_matches(if_range, info):
+    """
+    If-Range has either the ETag or the Last-Modified date, only an exact match keeps the range
+    """
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == info.etag
+    return if_range == info.last_modified
+
+
+class FileBody(object):
+    """
+    A file limited to `length` bytes from its current position. fileno() lets servers
+    send it with sendfile(), they send Content-Length bytes from the current position.
+    """
+
+    def __init__(self, fileobj, length):
+        self.file = fileobj
+        self.remaining = length
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ''
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def open_file(root, name, info):
+    """
+    Open the file, returns it with its FileInfo, refreshed if the file changed since it was cached
+    """
+    fileobj = open(info.path, 'rb')
+    try:
+        stat_result = os.fstat(fileobj.fileno())
+    except Exception:
+        fileobj.close()
+        raise
+    if not info.matches(stat_result):
+        info = FileInfo(info.path, stat_result)
+        file_cache().put((root, name), info)
+    return fileobj, info
+
+
+def wrap(environ, body):
+    """
+    The iterable returned by application() for a file body
+    """
+    file_wrapper = environ.get('wsgi.file_wrapper', FileWrapper)
+    return file_wrapper(body, BLOCK_SIZE)
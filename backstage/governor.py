@@ -0,0 +1,207 @@
+"""
+Admission control for application().
+
+A global in-flight limit, per API concurrency quotas declared with
+max_concurrency on <api> and a deadline on the time a request waited before
+it reached backstage. The counters live in shared memory allocated before the
+server forks so that every worker sees the same counts.
+
+Every worker counts its requests in its own row and the limits are checked
+against the sum of the rows. A worker that is killed in the middle of a
+request leaves counts behind, so the server zeroes its row through reap() and
+rows of dead workers are also cleared before a request is rejected. The lock
+is only taken by a worker claiming its row, with a timeout.
+"""
+
+import errno
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import core_exceptions
+
+logger = logging.getLogger('backstage')
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class Governor(object):
+    def __init__(self):
+        self.lock = None
+        self.counts = None
+        self.pids = None
+        self.width = 0
+        self.row = None
+        self.row_pid = None
+        self.local = None
+        # Only this process writes to its row, its threads take turns with this lock
+        self.row_lock = threading.Lock()
+
+    def setup(self, apis):
+        """
+        Allocate the shared counters, has to be called before the workers are forked.
+        Slot 0 counts every request in flight, the other slots belong to the APIs with a quota.
+        """
+        from conf.settings import GOVERNOR_MAX_WORKERS
+
+        slots = 1
+        for api in apis:
+            api.max_concurrency = int(getattr(api, 'max_concurrency', 0) or 0)
+            if api.max_concurrency:
+                api.governor_slot = slots
+                slots += 1
+            else:
+                api.governor_slot = None
+
+        self.width = slots
+        self.lock = multiprocessing.Lock()
+        self.pids = multiprocessing.RawArray('i', GOVERNOR_MAX_WORKERS)
+        self.counts = multiprocessing.RawArray('i', GOVERNOR_MAX_WORKERS * slots)
+        self.row = self.row_pid = None
+        self.local = [0] * slots
+
+    def own_row(self):
+        """
+        The row of this process, claimed the first time it admits a request. None when no row
+        could be claimed, the process then only counts its own requests.
+        """
+        from conf.settings import GOVERNOR_LOCK_TIMEOUT
+
+        pid = os.getpid()
+        if self.row_pid == pid:
+            return self.row
+        with self.row_lock:
+            if self.row_pid == pid:
+                return self.row
+            self.row = None
+            # A worker killed while holding the lock must not stop the others from starting
+            if self.lock.acquire(True, GOVERNOR_LOCK_TIMEOUT):
+                try:
+                    self.row = self.claim_row(pid)
+                finally:
+                    self.lock.release()
+            else:
+                logger.error("Admission control lock not acquired in %ss, worker %s counts its own "
+                             "requests only" % (GOVERNOR_LOCK_TIMEOUT, pid))
+            self.row_pid = pid
+            return self.row
+
+    def claim_row(self, pid):
+        for attempt in range(2):
+            for row in range(len(self.pids)):
+                if self.pids[row] in (0, pid):
+                    self.pids[row] = pid
+                    return row
+            self.reap_dead()
+        logger.warning("No admission control row left for worker %s, raise GOVERNOR_MAX_WORKERS" % pid)
+        return None
+
+    def reap(self, pid):
+        """
+        Zero the counts of a worker that exited, called by the server when it notices
+        """
+        if self.pids is None:
+            return
+        for row in range(len(self.pids)):
+            if self.pids[row] == pid:
+                for slot in range(row * self.width, (row + 1) * self.width):
+                    self.counts[slot] = 0
+                self.pids[row] = 0
+
+    def reap_dead(self):
+        for row in range(len(self.pids)):
+            pid = self.pids[row]
+            if pid and not is_alive(pid):
+                logger.warning("Clearing the admission control counts of dead worker %s" % pid)
+                self.reap(pid)
+
+    def total(self, row, slot):
+        total = sum(self.counts[index * self.width + slot] for index in range(len(self.pids)))
+        if row is None:
+            total += self.local[slot]
+        return total
+
+    def over_limit(self, api, row, slot):
+        from conf.settings import MAX_IN_FLIGHT
+
+        if MAX_IN_FLIGHT and self.total(row, 0) > MAX_IN_FLIGHT:
+            return "Server is over capacity", "%s requests in flight" % (self.total(row, 0) - 1)
+        if slot and self.total(row, slot) > api.max_concurrency:
+            return "API %s is over capacity" % api.name, "API concurrency of %s reached" % api.max_concurrency
+        return None
+
+    def add(self, row, slot, amount):
+        with self.row_lock:
+            if row is None:
+                self.local[0] += amount
+                if slot:
+                    self.local[slot] += amount
+                return
+            self.counts[row * self.width] += amount
+            if slot:
+                self.counts[row * self.width + slot] += amount
+
+    def queue_time(self, environ):
+        """
+        Seconds the request waited before processing started. The start time comes from the
+        server ( backstage.request_start ) or from a proxy X-Request-Start header.
+        """
+        started = environ.get('backstage.request_start')
+        if started is None:
+            header = environ.get('HTTP_X_REQUEST_START')
+            if not header:
+                return 0
+            try:
+                started = float(header.lstrip('t='))
+            except ValueError:
+                return 0
+            # Proxies send seconds, milliseconds or microseconds since the epoch
+            if started > 1e14:
+                started /= 1e6
+            elif started > 1e11:
+                started /= 1e3
+        return max(0, time.time() - started)
+
+    def admit(self, environ, api):
+        from conf.settings import MAX_QUEUE_TIME
+
+        if MAX_QUEUE_TIME:
+            waited = self.queue_time(environ)
+            if waited > MAX_QUEUE_TIME:
+                logger.warning("Rejecting request to %s, it waited %.3fs in the queue" % (api.name, waited))
+                raise core_exceptions.Raise503Exception("Request waited too long to be processed")
+
+        if self.counts is None:
+            from core import APIS
+            self.setup(APIS.apis)
+
+        slot = getattr(api, 'governor_slot', None)
+        row = self.own_row()
+        environ['backstage.governor_row'] = row
+
+        # Counted first and checked after, two workers admitting at the same time can both be
+        # turned away but never both let in over the limit
+        self.add(row, slot, 1)
+        rejected = self.over_limit(api, row, slot)
+        if rejected:
+            # The counts may belong to workers that were killed in the middle of a request
+            self.reap_dead()
+            rejected = self.over_limit(api, row, slot)
+        if rejected:
+            self.add(row, slot, -1)
+            logger.warning("Rejecting request to %s, %s" % (api.name, rejected[1]))
+            raise core_exceptions.Raise503Exception(rejected[0])
+
+    def release(self, environ, api):
+        self.add(environ.get('backstage.governor_row'), getattr(api, 'governor_slot', None), -1)
+
+
+governor = Governor()
@@ -0,0 +1,191 @@
+"""
+Outbound HTTP client used by the call mediator.
+
+Every worker process keeps a pool of persistent keep-alive connections per
+host so proxied requests do not pay for TCP/TLS setup each time.
+"""
+
+import httplib
+import logging
+import os
+import socket
+import threading
+import time
+import urlparse
+
+import core_exceptions
+
+logger = logging.getLogger('backstage')
+
+# Methods that can be sent again when a reused connection fails
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+
+
+class ConnectionPool(object):
+    def __init__(self, scheme, host, port, max_size, idle_timeout):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.size = 0
+        self.idle = []
+        self.condition = threading.Condition()
+
+    def new_connection(self, connect_timeout):
+        if self.scheme == 'https':
+            connection = httplib.HTTPSConnection(self.host, self.port, timeout=connect_timeout)
+        else:
+            connection = httplib.HTTPConnection(self.host, self.port, timeout=connect_timeout)
+        connection.connect()
+        return connection
+
+    def acquire(self, connect_timeout):
+        """
+        Returns (connection, reused). Waits up to connect_timeout for a free slot
+        when the pool is at its size limit.
+        """
+        deadline = time.time() + connect_timeout
+        with self.condition:
+            while True:
+                while self.idle:
+                    connection, released_at = self.idle.pop()
+                    if time.time() - released_at < self.idle_timeout:
+                        return connection, True
+                    connection.close()
+                    self.size -= 1
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise core_exceptions.PoolExhaustedException(
+                        "No free connection to %s:%s within %ss" % (self.host, self.port, connect_timeout))
+                self.condition.wait(remaining)
+
+        try:
+            return self.new_connection(connect_timeout), False
+        except:
+            self.discard(None)
+            raise
+
+    def release(self, connection):
+        with self.condition:
+            self.idle.append((connection, time.time()))
+            self.condition.notify()
+
+    def discard(self, connection):
+        if connection is not None:
+            connection.close()
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(scheme, host, port):
+    """
+    Pools are per worker, a forked worker must never reuse the sockets of its parent.
+    """
+    global _pools, _pools_pid
+    from conf.settings import CALL_POOL_SIZE, CALL_IDLE_TIMEOUT
+
+    key = (scheme, host, port)
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools = {}
+            _pools_pid = os.getpid()
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(scheme, host, port, CALL_POOL_SIZE, CALL_IDLE_TIMEOUT)
+    return pool
+
+
+def _read_body(response, max_response_size):
+    content_length = response.getheader('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > max_response_size:
+        raise core_exceptions.ResponseTooLargeException(
+            "Response of %s bytes is larger than %s bytes" % (content_length, max_response_size))
+    body = response.read(max_response_size + 1)
+    if len(body) > max_response_size:
+        raise core_exceptions.ResponseTooLargeException(
+            "Response is larger than %s bytes" % max_response_size)
+    return body
+
+
+def request(method, url, body=None, headers=None, connect_timeout=None, read_timeout=None,
+            max_response_size=None, deadline=None):
+    """
+    Send a request over a pooled connection and return
+    (status_code, reason, headers, body). The timeouts never go past the deadline.
+    """
+    from conf.settings import CALL_CONNECT_TIMEOUT, CALL_READ_TIMEOUT, CALL_MAX_RESPONSE_SIZE
+
+    connect_timeout = connect_timeout or CALL_CONNECT_TIMEOUT
+    read_timeout = read_timeout or CALL_READ_TIMEOUT
+    max_response_size = max_response_size or CALL_MAX_RESPONSE_SIZE
+
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise core_exceptions.Raise504Exception("Deadline exceeded before calling %s " % url)
+        connect_timeout = min(connect_timeout, remaining)
+        read_timeout = min(read_timeout, remaining)
+
+    parsed = urlparse.urlsplit(url)
+    scheme = parsed.scheme or 'http'
+    if scheme not in ('http', 'https'):
+        raise core_exceptions.CallException("Unsupported scheme in %s " % url)
+    port = parsed.port or (443 if scheme == 'https' else 80)
+    path = parsed.path or '/'
+    if parsed.query:
+        path = "%s?%s" % (path, parsed.query)
+
+    pool = get_pool(scheme, parsed.hostname, port)
+
+    # A keep-alive connection may have been closed by the server while it was idle,
+    # such a connection is retried once on a fresh one. The server may also have processed
+    # the request before the connection failed, so only idempotent requests are retried.
+    attempts = 2 if method in IDEMPOTENT_METHODS else 1
+    while attempts:
+        attempts -= 1
+        try:
+            connection, reused = pool.acquire(connect_timeout)
+        except socket.timeout:
+            raise core_exceptions.CallTimeoutException("Connecting to %s timed out " % url)
+        except socket.error, e:
+            raise core_exceptions.CallException("Connecting to %s failed: %s " % (url, e))
+
+        try:
+            connection.sock.settimeout(read_timeout)
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+        except socket.timeout:
+            pool.discard(connection)
+            raise core_exceptions.CallTimeoutException("Request to %s timed out " % url)
+        except (httplib.HTTPException, socket.error), e:
+            pool.discard(connection)
+            if reused and attempts:
+                logger.debug("Stale connection to %s, retrying on a new connection" % parsed.netloc)
+                continue
+            raise core_exceptions.CallException("Request to %s failed: %s " % (url, e))
+
+        try:
+            response_body = _read_body(response, max_response_size)
+        except socket.timeout:
+            pool.discard(connection)
+            raise core_exceptions.CallTimeoutException("Reading the response of %s timed out " % url)
+        except:
+            pool.discard(connection)
+            raise
+
+        if response.will_close:
+            pool.discard(connection)
+        else:
+            pool.release(connection)
+
+        return response.status, response.reason, dict(response.getheaders()), response_body
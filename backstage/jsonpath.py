@@ -0,0 +1,183 @@
+"""
+A small path and projection language for JSON payloads, compiled to closures.
+
+    user.name                   a value
+    items[0].id                 an index, negative indexes count from the end
+    items[*].id                 every item, the rest of the path is applied to each of them
+    accounts.*.balance          every value of an object
+    {id: user.id, tags: tags}   a new object built from paths
+    items[*].{id: id, n: name}  a list of new objects
+
+Keys that are not identifiers can be quoted, 'content-type'. A leading $ or $.
+is allowed. Missing keys give None and projections leave out the None results.
+"""
+
+import re
+
+TOKENS = re.compile(r"""\s*(?:
+    (?P<number>-?\d+) |
+    (?P<name>[A-Za-z_][\w\-]*) |
+    '(?P<single>[^']*)' |
+    "(?P<double>[^"]*)" |
+    (?P<punctuation>[.\[\]{}:,*$])
+)""", re.VERBOSE)
+
+_compiled = {}
+
+
+class PathSyntaxError(Exception):
+    pass
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKENS.match(expression, position)
+        if not match:
+            raise PathSyntaxError("Unexpected %r at %d in %s" % (expression[position:], position, expression))
+        position = match.end()
+        if match.group('number') is not None:
+            tokens.append(('number', int(match.group('number'))))
+        elif match.group('name') is not None:
+            tokens.append(('name', match.group('name')))
+        elif match.group('single') is not None:
+            tokens.append(('name', match.group('single')))
+        elif match.group('double') is not None:
+            tokens.append(('name', match.group('double')))
+        else:
+            tokens.append((match.group('punctuation'), None))
+    return tokens
+
+
+def _key(name, next_step):
+    def step(value):
+        if isinstance(value, dict):
+            return next_step(value.get(name))
+        return None
+    return step
+
+
+def _index(index, next_step):
+    def step(value):
+        if isinstance(value, list) and -len(value) <= index < len(value):
+            return next_step(value[index])
+        return None
+    return step
+
+
+def _wildcard(next_step):
+    def step(value):
+        if isinstance(value, dict):
+            values = value.itervalues()
+        elif isinstance(value, list):
+            values = value
+        else:
+            return None
+        return [result for result in (next_step(item) for item in values) if result is not None]
+    return step
+
+
+def _object(fields, next_step):
+    def step(value):
+        if value is None:
+            return None
+        return next_step(dict((name, field(value)) for name, field in fields))
+    return step
+
+
+def _identity(value):
+    return value
+
+
+class Parser(object):
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def take(self, kind):
+        if self.peek() != kind:
+            raise PathSyntaxError("Expected %s at token %d in %s" % (kind, self.position, self.expression))
+        token = self.tokens[self.position]
+        self.position += 1
+        return token[1]
+
+    def parse(self):
+        if self.peek() == '$':
+            self.take('$')
+            if self.peek() == '.':
+                self.take('.')
+        path = self.path()
+        if self.peek() is not None:
+            raise PathSyntaxError("Unexpected token at %d in %s" % (self.position, self.expression))
+        return path
+
+    def path(self):
+        """
+        Steps are collected as factories and chained from the end, each step calls the next one
+        """
+        factories = []
+        while True:
+            kind = self.peek()
+            if kind == 'name':
+                name = self.take('name')
+                factories.append(lambda next_step, name=name: _key(name, next_step))
+            elif kind == '*':
+                self.take('*')
+                factories.append(_wildcard)
+            elif kind == '{':
+                fields = self.fields()
+                factories.append(lambda next_step, fields=fields: _object(fields, next_step))
+            elif kind == '[':
+                self.take('[')
+                if self.peek() == '*':
+                    self.take('*')
+                    factories.append(_wildcard)
+                else:
+                    index = self.take('number')
+                    factories.append(lambda next_step, index=index: _index(index, next_step))
+                self.take(']')
+            else:
+                break
+            if self.peek() == '.':
+                self.take('.')
+            elif self.peek() not in ('[',):
+                break
+
+        if not factories:
+            raise PathSyntaxError("Empty path in %s" % self.expression)
+        step = _identity
+        for factory in reversed(factories):
+            step = factory(step)
+        return step
+
+    def fields(self):
+        self.take('{')
+        fields = []
+        while True:
+            name = self.take('name')
+            self.take(':')
+            fields.append((name, self.path()))
+            if self.peek() == ',':
+                self.take(',')
+                continue
+            break
+        self.take('}')
+        return fields
+
+
+def compile_path(expression):
+    """
+    Compile a path or projection into a function of the payload, compiled once per expression
+    """
+    path = _compiled.get(expression)
+    if path is None:
+        path = _compiled[expression] = Parser(expression).parse()
+    return path
@@ -1,10 +1,21 @@
+import bisect
 import json
 import logging
+import os
 import re
+import sre_constants
+import sre_parse
 import urlparse
 import uuid
+import compression
+import conditional
 import core_exceptions
-from core import Mediator
+import expressions
+import files
+import http_client
+import jsonpath
+import validation
+from core import Mediator, Response
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('backstage')
@@ -28,6 +39,7 @@ class NamedSequence(Sequence):
     def mediate(self, context):
         logger.info("Running named sequence %s" % self.name)
         for sequence in NamedSequences.sequences[self.name]:
+            context.check_deadline()
             sequence.mediate(context)
 
 
@@ -107,6 +119,9 @@ class Property(Mediator):
             if value.startswith('$random_id'):
                 final_value = self.random_id()
 
+            elif value.startswith("$body"):
+                final_value = context.evaluate(value)
+
             elif value.startswith("$context.") or value.startswith("$request.") or value.startswith(
                     "$response.") or value.startswith("$header"):
                 backstage_value, value_parameter = value.split(".")
@@ -143,7 +158,9 @@ class Log(Mediator):
         # TODO: Integrate format and handler later.
         log_method = getattr(logger, self.category)
         log_expression = self.value
-        if hasattr(self, 'expression'):
+        if hasattr(self, 'expression') and self.expression.startswith('$'):
+            log_method("%s%s" % (log_expression, context.evaluate(self.expression)))
+        elif hasattr(self, 'expression'):
             # Check the context variable first and then request
             from_expression = context.from_context(self.expression) or context.from_request(self.expression)
             log_method("%s%s" % (log_expression, from_expression))
@@ -152,27 +169,244 @@ class Log(Mediator):
 
 
 class Switch(Mediator):
+    """
+    Runs the first case, in document order, that matches the switch condition and the default
+    cases when none does. The cases are indexed when the XML is loaded: values and 'in' lists go
+    into a dict, the 'regex' cases into one alternation and the 'min' / 'max' ranges into sorted
+    intervals, so finding the case does not depend on the number of cases.
+
+    <switch expression="$header.x-tenant">
+        <case value="acme">...</case>
+        <case in="globex,initech">...</case>
+        <case regex="beta-.*">...</case>
+        <case min="100" max="199">...</case>
+        <default>...</default>
+    </switch>
+    """
     run_sequence_first = False
 
     def __init__(self):
         super(Switch, self).__init__()
 
+    def prepare(self):
+        if getattr(self, 'from_header', None):
+            self.condition = lambda context, name=self.from_header: context.from_request(name)
+        elif getattr(self, 'from_context', None):
+            self.condition = lambda context, name=self.from_context: context.from_context(name)
+        elif getattr(self, 'expression', None):
+            self.condition = expressions.compile_expression(self.expression)
+        else:
+            self.condition = None
+
+        self.cases = []
+        self.defaults = []
+        self.others = []
+        self.exact = {}
+        patterns = []
+        self.own_patterns = []
+        ranges = []
+        for child in self.sequence_list:
+            if isinstance(child, Case):
+                position = len(self.cases)
+                self.cases.append(child)
+                if child.pattern is not None and stands_alone(child.pattern):
+                    self.own_patterns.append((position, child))
+                elif child.pattern is not None:
+                    patterns.append((position, child.pattern))
+                elif child.values is not None:
+                    for value in child.values:
+                        self.exact.setdefault(value, position)
+                else:
+                    ranges.append((child.low, child.high, position))
+            elif isinstance(child, Default):
+                self.defaults.append(child)
+            else:
+                self.others.append(child)
+
+        self.regexes = build_alternations(patterns)
+        self.bounds, self.range_cases = build_intervals(ranges)
+
+    def find_case(self, condition):
+        """
+        Position of the first case matching the condition, None when there is none
+        """
+        if condition is None:
+            return None
+        key = condition if isinstance(condition, basestring) else str(condition)
+        position = self.exact.get(key)
+
+        for regex, regex_cases in self.regexes:
+            match = regex.match(key)
+            if match is not None:
+                matched = regex_cases[match.lastindex]
+                if position is None or matched < position:
+                    position = matched
+                break
+
+        # Patterns that cannot be part of an alternation, in document order
+        for matched, case in self.own_patterns:
+            if position is not None and matched > position:
+                break
+            if case.full_match(key) is not None:
+                position = matched
+                break
+
+        if self.range_cases:
+            number = as_number(condition)
+            if number is not None:
+                index = bisect.bisect_left(self.bounds, number)
+                if index < len(self.bounds) and self.bounds[index] == number:
+                    matched = self.range_cases[2 * index + 1]
+                else:
+                    matched = self.range_cases[2 * index]
+                if matched is not None and (position is None or matched < position):
+                    position = matched
+        return position
+
     def mediate(self, context):
         logger.info("Inside the switch mediator ")
         context.is_default = True
-        if hasattr(self, 'from_header') and self.from_header:
-            context.switch_condition = context.from_request(self.from_header)
-        elif hasattr(self, 'from_context') and self.from_context:
-            context.switch_condition = context.from_context(self.from_context)
+        if self.condition is not None:
+            context.switch_condition = self.condition(context)
         else:
             logger.error("This switch condition cannot be recognized setting default")
-        self.run_internal_sequences(context)
+
+        for mediator in self.others:
+            context.check_deadline()
+            mediator.mediate(context)
+
+        position = self.find_case(getattr(context, 'switch_condition', None))
+        if position is not None:
+            context.is_default = False
+            context.check_deadline()
+            self.cases[position].run_internal_sequences(context)
+        else:
+            for default in self.defaults:
+                default.mediate(context)
+
+
+def as_number(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def refers_to_groups(parsed):
+    """
+    True when a parsed pattern has a backreference or a conditional on a group
+    """
+    for op, argument in parsed:
+        if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return True
+        items = [argument]
+        while items:
+            item = items.pop()
+            if isinstance(item, sre_parse.SubPattern):
+                if refers_to_groups(item):
+                    return True
+            elif isinstance(item, (list, tuple)):
+                items.extend(item)
+    return False
+
+
+def stands_alone(pattern):
+    """
+    Patterns with named groups, backreferences or inline flags would break or change the other
+    cases of an alternation, their groups are renumbered and the flags apply to the whole of it
+    """
+    return bool(pattern.groupindex or pattern.flags & ~re.UNICODE or
+                refers_to_groups(sre_parse.parse(pattern.pattern)))
+
+
+def build_alternations(patterns):
+    """
+    Combine the ( position, compiled pattern ) of the regex cases into alternations of whole
+    matches. The re module allows 100 groups per expression so large tables get several
+    alternations, in document order. Returns ( regex, {group index: position} ) pairs.
+    """
+    if not patterns:
+        return []
+    alternations = []
+    chunk = []
+    groups = 0
+    for position, pattern in patterns + [(None, None)]:
+        if pattern is None or (chunk and groups + pattern.groups + 1 > 99):
+            regex = re.compile('|'.join('(?P<_c%d>%s)\\Z' % (case, text) for case, text in chunk))
+            # The outer group of an alternative closes last so it is the lastindex of a match
+            alternations.append((regex, dict((index, int(name[2:])) for name, index in regex.groupindex.items()
+                                             if name.startswith('_c') and name[2:].isdigit())))
+            chunk, groups = [], 0
+        if pattern is not None:
+            chunk.append((position, pattern.pattern))
+            groups += pattern.groups + 1
+    return alternations
+
+
+def build_intervals(ranges):
+    """
+    Split the ( low, high, position ) ranges, bounds included and None for no bound, into
+    elementary intervals. Returns the sorted bounds and, for every interval, the first position
+    covering it: slot 2 * i is the open interval below bounds[i] and slot 2 * i + 1 is bounds[i].
+    """
+    bounds = sorted(set(bound for low, high, position in ranges for bound in (low, high) if bound is not None))
+    if not ranges:
+        return bounds, []
+
+    def first_covering(number):
+        covering = [position for low, high, position in ranges
+                    if (low is None or low <= number) and (high is None or number <= high)]
+        return min(covering) if covering else None
+
+    if not bounds:
+        return bounds, [first_covering(0)]
+    slots = []
+    for index, bound in enumerate(bounds):
+        below = bound - 1 if index == 0 else (bounds[index - 1] + bound) / 2.0
+        slots.append(first_covering(below))
+        slots.append(first_covering(bound))
+    slots.append(first_covering(bounds[-1] + 1))
+    return bounds, slots
 
 
 class Case(Mediator):
+    """
+    Matches the switch condition against a 'value', a comma separated 'in' list, a 'regex'
+    that has to match the whole condition or a numeric range with 'min' and / or 'max'.
+    Values are compared as strings.
+    """
     def __init__(self):
         super(Case, self).__init__()
 
+    def prepare(self):
+        self.values = None
+        self.pattern = None
+        self.low = self.high = None
+        if hasattr(self, 'regex'):
+            self.pattern = re.compile(self.regex)
+            self.full_match = re.compile('(?:%s)\\Z' % self.regex).match
+        elif hasattr(self, 'in'):
+            self.values = set(value.strip() for value in getattr(self, 'in').split(','))
+        elif hasattr(self, 'min') or hasattr(self, 'max'):
+            self.low = float(self.min) if hasattr(self, 'min') else None
+            self.high = float(self.max) if hasattr(self, 'max') else None
+        else:
+            self.values = set([self.value])
+
+    def matches(self, condition):
+        if condition is None:
+            return False
+        key = condition if isinstance(condition, basestring) else str(condition)
+        if self.pattern is not None:
+            return self.full_match(key) is not None
+        if self.values is not None:
+            return key in self.values
+        number = as_number(condition)
+        return number is not None and (self.low is None or self.low <= number) and \
+            (self.high is None or number <= self.high)
+
     def mediate(self, context):
         logger.debug("Inside the Case Mediator ")
 
@@ -181,7 +415,7 @@ class Case(Mediator):
             raise Exception("No switch condition ")
 
         logger.info("This is the switch condition %s " % context.switch_condition)
-        if self.value == context.switch_condition:
+        if self.matches(context.switch_condition):
             self.run_internal_sequences(context)
             context.is_default = False
         else:
@@ -205,19 +439,15 @@ class Payload(Mediator):
 
 
 class Use(Mediator):
+    def prepare(self):
+        self.value_accessor = expressions.compile_expression(self.value)
+
     def mediate(self, context):
         """
-        The use mediator uses values from the context, request or header to set values into 
+        The use mediator uses values from the context, request, header or body to set values into 
         a payload object present in the context
         """
-        value_to_be_obtained = None
-
-        if self.value.startswith("$context"):
-            value_to_be_obtained = getattr(context, self.value.split(".")[1], None)
-        elif self.value.startswith("$request"):
-            value_to_be_obtained = getattr(context.request, self.value.split(".")[1], None)
-        elif self.value.startswith('$header'):
-            value_to_be_obtained = context.request.headers.get(self.value.split(".")[1])
+        value_to_be_obtained = self.value_accessor(context)
 
         if hasattr(context, self.payload):
             getattr(context, self.payload)[self.key] = value_to_be_obtained
@@ -226,9 +456,51 @@ class Use(Mediator):
 
 
 class ResponseMediator(Mediator):
+    """
+    The body is a static 'value', a 'template' ( or 'template_file' ) with {$context.name},
+    {$request.name} or {$header.name} placeholders, or a payload from the context ( 'use_payload' ).
+    Templates are compiled when the XML is loaded, escape="json" escapes the values for JSON
+    and stream="true" sends the template segment by segment.
+    """
+    def prepare(self):
+        from conf.settings import COMPRESSION_ENABLED, COMPRESSION_MIN_SIZE, COMPRESSION_LEVEL
+
+        text = getattr(self, 'template', None)
+        self.template = None
+        self.stream = getattr(self, 'stream', 'false') == 'true'
+        self.converter = None
+        if not hasattr(self, 'value'):
+            if hasattr(self, 'template_file'):
+                with open(os.path.join(self._base_dir, self.template_file)) as template_file:
+                    text = template_file.read()
+            if text is not None:
+                self.template = expressions.compile_template(text, getattr(self, 'escape', None))
+
+            # A template without placeholders is just a value
+            if self.template is not None and self.template.is_static():
+                self.value = ''.join(self.template.segments)
+                self.template = None
+
+        # lxml gives non ASCII attributes as unicode, bodies are sent as UTF-8
+        if isinstance(getattr(self, 'value', None), unicode):
+            self.value = self.value.encode('utf-8')
+
+        # Static bodies are compressed once here instead of on every response
+        self.precompressed = None
+        if hasattr(self, 'value') and COMPRESSION_ENABLED and len(self.value) >= COMPRESSION_MIN_SIZE:
+            value = str(self.value)
+            self.value = value
+            self.precompressed = (value, compression.precompress(value, COMPRESSION_LEVEL))
+
     def mediate(self, context):
         if hasattr(self, 'value'):
             context.response.message = self.value
+            context.response.precompressed = self.precompressed
+        elif self.template is not None:
+            if self.stream:
+                context.response.message = self.template.iter_render(context)
+            else:
+                context.response.message = self.template.render(context)
         else:
             # If a direct value is not set it is assumed that the response payload
             # would be set using use_payload
@@ -237,8 +509,10 @@ class ResponseMediator(Mediator):
             # If there is an attribute for conversion then find the handler and convert it
             if hasattr(self, 'convert'):
                 if not self.convert == 'False':
-                    from conf.settings import CONVERTERS
-                    context.response.message = CONVERTERS[self.convert]().convert(context.response.message)
+                    if self.converter is None:
+                        from conf.settings import CONVERTERS
+                        self.converter = CONVERTERS[self.convert]()
+                    context.response.message = self.converter.convert(context.response.message)
         context.response.status_code = self.status_code
         context.response.status_message = self.status_message
         self.run_internal_sequences(context)
@@ -259,6 +533,180 @@ class ViewMediator(Mediator):
         # Set the respose object into context
         context.response = response
 
+class CallMediator(Mediator):
+    """
+    Calls a backend over HTTP and stores the response in the context. Values of {$...}
+    placeholders in the endpoint are percent-encoded.
+
+    <call endpoint="http://backend/users/{$context.user_id}" method="POST" body="$context.payload"
+          store="backend_response">
+        <header name="accept" value="application/json" />
+    </call>
+    """
+    def prepare(self):
+        self.method = getattr(self, 'method', 'GET').upper()
+        self.store = getattr(self, 'store', 'call_response')
+        self.endpoint_value = expressions.compile_value(self.endpoint, 'url')
+        self.body_value = None
+        if hasattr(self, 'body'):
+            self.body_value = expressions.compile_value(self.body)
+
+        self.header_values = []
+        for header in self.sequence_list:
+            if isinstance(header, HttpHeaderMediator):
+                self.header_values.append((header.name, expressions.compile_value(header.value)))
+
+        self.connect_timeout = float(getattr(self, 'connect_timeout', 0)) or None
+        self.read_timeout = float(getattr(self, 'read_timeout', 0)) or None
+        self.max_response_size = int(getattr(self, 'max_response_size', 0)) or None
+
+    def mediate(self, context):
+        url = self.endpoint_value(context)
+        headers = dict((name, value(context)) for name, value in self.header_values)
+        body = None
+        if self.body_value is not None:
+            body = self.body_value(context)
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body)
+                if not any(name.lower() == 'content-type' for name in headers):
+                    headers['Content-Type'] = 'application/json'
+
+        logger.info("Calling %s %s " % (self.method, url))
+        status_code, reason, response_headers, response_body = http_client.request(
+            self.method, url, body, headers, connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout, max_response_size=self.max_response_size,
+            deadline=context.deadline)
+
+        response = Response(body=response_body, status_code=status_code, status_message=reason)
+        response.set_headers(response_headers)
+        setattr(context, self.store, response)
+
+
+class TransformMediator(Mediator):
+    """
+    Reshapes an XML or JSON payload in one pass and stores the result in the context
+
+    <transform xpath="//order/id/text()" source="$request.body" target="order_ids" />
+    <transform xslt="orders.xsl" target="orders_document" />
+    <transform select="items[*].{id: id, name: name}" source="$body" target="items" />
+    """
+    def prepare(self):
+        self.target = getattr(self, 'target', 'transform_result')
+
+        if hasattr(self, 'select'):
+            path = jsonpath.compile_path(self.select)
+            self.transform = lambda value: path(json.loads(value) if isinstance(value, basestring) else value)
+            source = getattr(self, 'source', '$body')
+        elif hasattr(self, 'xpath') or hasattr(self, 'xslt'):
+            import transforms
+
+            if hasattr(self, 'xpath'):
+                namespaces = dict(item.split('=', 1) for item in getattr(self, 'namespaces', '').split(',') if item)
+                xpath = transforms.compile_xpath(self.xpath, namespaces)
+                self.transform = lambda value: transforms.xpath_result(xpath(transforms.parse_xml(value)))
+            else:
+                xslt = transforms.compile_xslt(os.path.join(self._base_dir, self.xslt))
+                self.transform = lambda value: str(xslt(transforms.parse_xml(value)))
+            source = getattr(self, 'source', '$request.body')
+        else:
+            raise Exception("transform needs one of the select, xpath or xslt attributes ")
+
+        self.source_value = expressions.compile_expression(source)
+
+    def mediate(self, context):
+        setattr(context, self.target, self.transform(self.source_value(context)))
+
+
+class FileMediator(Mediator):
+    """
+    Sends a file from under 'root' ( relative to the XML file ) with its ETag and Last-Modified,
+    single byte ranges are answered with a 206
+
+    <file root="static" path="$request.view_args.0" cache_control="max-age=3600" />
+    """
+    def prepare(self):
+        self.root = os.path.realpath(os.path.join(self._base_dir, self.root))
+        self.path_value = expressions.compile_value(self.path)
+        self.content_type = getattr(self, 'content_type', None)
+        self.cache_control = getattr(self, 'cache_control', None)
+
+    def mediate(self, context):
+        name = self.path_value(context)
+        info = files.resolve(self.root, name) if isinstance(name, basestring) else None
+        if info is None:
+            raise core_exceptions.Raise404Exception("File %s not found " % name)
+
+        response = context.response
+        response.precompressed = None
+        environ = context.request.headers.environ
+        if conditional.is_not_modified(environ, info.etag, info.last_modified):
+            response.status_code = 304
+            response.status_message = "Not Modified"
+            response.message = ''
+        else:
+            try:
+                fileobj, info = files.open_file(self.root, name, info)
+            except IOError:
+                raise core_exceptions.Raise404Exception("File %s not found " % name)
+            start, end = 0, info.size - 1
+            response.status_code = 200
+            response.status_message = "OK"
+
+            byte_range = None
+            if_range = environ.get('HTTP_IF_RANGE')
+            if 'HTTP_RANGE' in environ and (not if_range or files.if_range_matches(if_range, info)):
+                byte_range = files.parse_range(environ['HTTP_RANGE'], info.size)
+            if byte_range is False:
+                fileobj.close()
+                response.status_code = 416
+                response.status_message = "Requested Range Not Satisfiable"
+                response.message = ''
+                response.headers['Content-Range'] = "bytes */%d" % info.size
+            else:
+                if byte_range:
+                    start, end = byte_range
+                    fileobj.seek(start)
+                    response.status_code = 206
+                    response.status_message = "Partial Content"
+                    response.headers['Content-Range'] = "bytes %d-%d/%d" % (start, end, info.size)
+                response.message = files.FileBody(fileobj, end - start + 1)
+                response.headers['Content-Length'] = str(end - start + 1)
+                response.headers['Content-Type'] = self.content_type or info.content_type
+
+        response.headers['Accept-Ranges'] = 'bytes'
+        conditional.set_validator_headers(response, info.etag, info.last_modified)
+        if self.cache_control:
+            response.headers['Cache-Control'] = self.cache_control
+        self.run_internal_sequences(context)
+
+
+class ValidateMediator(Mediator):
+    """
+    Checks the headers, the query parameters and the body against a spec compiled when the XML
+    is loaded. Invalid requests get a 400 with the list of errors and no other mediator runs,
+    from any sequence.
+
+    <validate schema="schemas/create_order.json" />
+    """
+    headers = {'Content-Type': 'application/json'}
+
+    def prepare(self):
+        with open(os.path.join(self._base_dir, self.schema)) as schema_file:
+            self.validator = validation.compile_spec(json.load(schema_file))
+
+    def mediate(self, context):
+        errors = self.validator(context.request)
+        if not errors:
+            return
+        logger.info("Request to %s is not valid: %s" % (context.request.url_path, errors))
+        context.response.status_code = 400
+        context.response.status_message = "Bad Request"
+        context.response.message = json.dumps({'errors': errors})
+        context.response.precompressed = None
+        context.response.set_headers(self.headers)
+        raise core_exceptions.RequestInvalidException("Request to %s is not valid " % context.request.url_path)
+
+
 class HttpHeaderMediator(Mediator):
     def mediate(self, context):
         context.response.headers[self.name] = self.value
@@ -0,0 +1,299 @@
+"""
+Opt-in memory accounting for application().
+
+With MEMORY_ACCOUNTING on, the memory used by every request is attributed to
+its API, its resource and the mediators that ran. Contexts that outlive their
+request and attributes written into the mediators, which are shared by every
+request, are reported. A summary of the worker's heap is logged every
+MEMORY_SUMMARY_INTERVAL seconds and served at MEMORY_DEBUG_URL, and the worker
+is recycled once its RSS goes over MEMORY_MAX_RSS.
+
+Allocations are measured with tracemalloc when it can be imported ( the
+pytracemalloc backport on Python 2 ), with the resident set size otherwise.
+Both are per process, so the requests running in the other threads of a
+worker are counted as well and the numbers are only good as totals over many
+requests.
+"""
+
+import gc
+import json
+import logging
+import os
+import resource
+import signal
+import threading
+import time
+import types
+import weakref
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+logger = logging.getLogger('backstage')
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def rss():
+    """
+    Resident set size of the worker in bytes, the peak size where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def traced():
+    return tracemalloc.get_traced_memory()[0]
+
+
+class Usage(object):
+    __slots__ = ('calls', 'net', 'grown')
+
+    def __init__(self):
+        self.calls = 0
+        # Sum of the differences and of the increases only, memory freed later shows in the first
+        self.net = 0
+        self.grown = 0
+
+    def add(self, size):
+        self.calls += 1
+        self.net += size
+        if size > 0:
+            self.grown += size
+
+    def as_dict(self):
+        return {'calls': self.calls, 'net': self.net, 'grown': self.grown,
+                'average': self.net // self.calls if self.calls else 0}
+
+
+def resource_label(api, api_resource):
+    return ' '.join(filter(None, [api.name, api_resource.method, getattr(api_resource, 'uri-template', None)]))
+
+
+def class_state(klass):
+    """
+    The plain values set on a mediator class, functions and descriptors left out
+    """
+    return dict((name, value) for name, value in vars(klass).items()
+                if not name.startswith('__') and not callable(value)
+                and not isinstance(value, (property, staticmethod, classmethod)))
+
+
+class MemoryAccounting(object):
+    def __init__(self):
+        self.enabled = False
+        self.debug_url = None
+        self.max_rss = 0
+        self.measure = rss
+        self.lock = threading.Lock()
+        self.usage = {'api': {}, 'resource': {}, 'mediator': {}}
+        self.mediators = []
+        self.finished = weakref.WeakSet()
+        self.requests = 0
+        self.last_summary = time.time()
+        self.recycling = False
+        self.baseline = None
+
+    def setup(self, apis):
+        """
+        Instrument the parsed mediators, has to be called once the XML is loaded
+        """
+        from conf.settings import MEMORY_ACCOUNTING, MEMORY_DEBUG_URL, MEMORY_MAX_RSS
+        from mediators import NamedSequences
+
+        self.enabled = bool(MEMORY_ACCOUNTING)
+        if not self.enabled:
+            return
+        self.debug_url = MEMORY_DEBUG_URL
+        self.max_rss = MEMORY_MAX_RSS * 1024 * 1024
+
+        if tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.measure = traced
+
+        self.mediators = []
+        for api in apis:
+            for api_resource in api.resources:
+                label = resource_label(api, api_resource)
+                for sequence_type in ('in', 'out', 'fault'):
+                    sequence = getattr(api_resource, '%s_sequence' % sequence_type)
+                    for index, mediator in enumerate(sequence.sequence_list):
+                        self.instrument(mediator, "%s %sSequence.%d" % (label, sequence_type, index))
+        for name, sequence_list in NamedSequences.sequences.items():
+            for index, mediator in enumerate(sequence_list):
+                self.instrument(mediator, "sequence %s.%d" % (name, index))
+
+        self.baseline = self.shared_state()
+        logger.info("Memory accounting with %s for %s mediators" % (
+            'tracemalloc' if self.measure is traced else 'the RSS', len(self.mediators)))
+
+    def instrument(self, mediator, label):
+        label = "%s.%s" % (label, mediator.__class__.__name__)
+        for index, child in enumerate(mediator.sequence_list):
+            self.instrument(child, "%s.%d" % (label, index))
+
+        usage = self.usage['mediator'].setdefault(label, Usage())
+        mediate = mediator.mediate
+        lock = self.lock
+        measure = self.measure
+
+        def measured(context):
+            before = measure()
+            try:
+                return mediate(context)
+            finally:
+                size = measure() - before
+                with lock:
+                    usage.add(size)
+
+        # Only this instance is wrapped, the accounting costs nothing while it is off
+        mediator.mediate = measured
+        self.mediators.append((label, mediator))
+
+    def start(self):
+        if not self.enabled:
+            return None
+        return self.measure()
+
+    def finish(self, environ, context, api, api_resource, start):
+        """
+        Attribute the memory of a finished request and keep a weak reference to its context
+        """
+        if start is None:
+            return
+        from conf.settings import MEMORY_SUMMARY_INTERVAL
+
+        size = self.measure() - start
+        with self.lock:
+            self.usage['api'].setdefault(api.name, Usage()).add(size)
+            if api_resource is not None:
+                self.usage['resource'].setdefault(resource_label(api, api_resource), Usage()).add(size)
+            self.requests += 1
+
+        now = time.time()
+        if MEMORY_SUMMARY_INTERVAL and now - self.last_summary >= MEMORY_SUMMARY_INTERVAL:
+            self.last_summary = now
+            logger.info("Memory summary %s" % json.dumps(self.summary()))
+
+        if self.max_rss and not self.recycling and rss() >= self.max_rss:
+            self.recycle(environ)
+        self.finished.add(context)
+
+    def recycle(self, environ):
+        """
+        Ask the server to replace the worker once the requests in flight are done. The prefork
+        server passes a hook, other forking servers such as gunicorn stop a worker on SIGTERM.
+        """
+        self.recycling = True
+        logger.warning("Worker %s is over MEMORY_MAX_RSS, recycling. Memory summary %s" % (
+            os.getpid(), json.dumps(self.summary())))
+        hook = environ.get('backstage.recycle')
+        if hook is not None:
+            hook()
+        elif environ.get('wsgi.multiprocess'):
+            os.kill(os.getpid(), signal.SIGTERM)
+        else:
+            logger.warning("A single process server cannot recycle worker %s" % os.getpid())
+
+    def shared_state(self):
+        from core import APIS
+        from mediators import NamedSequences
+
+        return {
+            'containers': {
+                'APIS.apis': len(APIS.apis),
+                'APIS.urls_and_apis': len(APIS.urls_and_apis),
+                'APIS.sequences': len(APIS.sequences),
+                'NamedSequences.sequences': len(NamedSequences.sequences),
+            },
+            'mediators': dict((label, set(vars(mediator))) for label, mediator in self.mediators),
+            'classes': dict((mediator.__class__, class_state(mediator.__class__))
+                            for label, mediator in self.mediators),
+        }
+
+    def shared_state_growth(self):
+        """
+        What was added to the shared objects since the XML was loaded, mediators are shared by
+        every request so attributes written into them at request time leak between requests
+        """
+        current = self.shared_state()
+        growth = {}
+        for name, size in current['containers'].iteritems():
+            if size != self.baseline['containers'][name]:
+                growth[name] = "%s -> %s" % (self.baseline['containers'][name], size)
+        for label, names in current['mediators'].iteritems():
+            added = names - self.baseline['mediators'].get(label, set())
+            if added:
+                growth[label] = sorted(added)
+        for klass, state in current['classes'].iteritems():
+            before = self.baseline['classes'].get(klass, {})
+            changed = [name for name, value in state.iteritems() if name not in before or before[name] is not value]
+            if changed:
+                growth["class %s" % klass.__name__] = sorted(changed)
+        return growth
+
+    def leaked_contexts(self):
+        """
+        Contexts still alive after their request and what holds on to them. The last exception
+        handled by each thread keeps its frames alive, so up to one context per thread is expected.
+        """
+        gc.collect()
+        alive = list(self.finished)
+        holders = set()
+        for context in alive[:5]:
+            for referrer in gc.get_referrers(context):
+                if referrer is alive or isinstance(referrer, types.FrameType):
+                    continue
+                if isinstance(referrer, dict):
+                    owners = [owner for owner in gc.get_referrers(referrer)
+                              if getattr(owner, '__dict__', None) is referrer]
+                    if owners:
+                        holders.add("%s attribute" % owners[0].__class__.__name__)
+                        continue
+                holders.add(referrer.__class__.__name__)
+        return len(alive), sorted(holders)
+
+    def summary(self):
+        from conf.settings import MEMORY_TOP
+
+        with self.lock:
+            usage = dict((kind, sorted(((name, entry.as_dict()) for name, entry in entries.iteritems()),
+                                       key=lambda item: item[1]['net'], reverse=True)[:MEMORY_TOP])
+                         for kind, entries in self.usage.iteritems())
+            requests = self.requests
+
+        leaked, holders = self.leaked_contexts()
+        summary = {
+            'pid': os.getpid(),
+            'rss': rss(),
+            'requests': requests,
+            'apis': usage['api'],
+            'resources': usage['resource'],
+            'mediators': usage['mediator'],
+            'leaked_contexts': leaked,
+            'leaked_context_holders': holders,
+            'shared_state_growth': self.shared_state_growth(),
+        }
+        if self.measure is traced:
+            current, peak = tracemalloc.get_traced_memory()
+            summary['traced'] = {'current': current, 'peak': peak}
+            summary['top_allocations'] = [str(statistic) for statistic in
+                                          tracemalloc.take_snapshot().statistics('lineno')[:MEMORY_TOP]]
+        return summary
+
+    def respond(self, start_response):
+        """
+        The summary of the worker that answered, for MEMORY_DEBUG_URL
+        """
+        body = json.dumps(self.summary(), indent=2)
+        start_response("200 OK", [("Content-type", "application/json"), ("Content-Length", str(len(body)))])
+        return iter([body])
+
+
+accounting = MemoryAccounting()
@@ -0,0 +1,577 @@
+"""
+A prefork, threaded HTTP/1.1 server for backstage.
+
+The parent parses the XML once, binds the listening socket ( unless every
+worker binds its own with SO_REUSEPORT ) and forks the workers. Each worker
+accepts connections into a bounded queue served by a fixed pool of threads,
+keeps connections alive between requests and exits gracefully after
+max_requests so the parent can replace it with a fresh one. A connection
+waiting for its next request is watched by the accept loop with poll(), it
+only goes back to the threads once the request arrives.
+"""
+
+import BaseHTTPServer
+import errno
+import fcntl
+import logging
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import urllib
+import Queue
+from wsgiref.util import FileWrapper
+
+from governor import governor
+
+logger = logging.getLogger('backstage')
+
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+
+
+class InputStream(object):
+    """
+    wsgi.input that never reads past the body, the rest of the stream belongs to the next request
+    """
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else ''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else ''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def drain(self):
+        while self.remaining:
+            if not self.read(min(self.remaining, 65536)):
+                break
+
+
+def read_chunked(rfile):
+    from StringIO import StringIO
+
+    body = StringIO()
+    while True:
+        size = int(rfile.readline().split(';', 1)[0].strip(), 16)
+        if size == 0:
+            # Skip the trailers
+            while rfile.readline() not in ('\r\n', '\n', ''):
+                pass
+            break
+        body.write(rfile.read(size))
+        rfile.readline()
+    return body.getvalue()
+
+
+class WSGIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'backstage'
+
+    def __init__(self, request, client_address, server):
+        # Only sets the connection up, the worker calls serve() whenever it has a request
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def setup(self):
+        self.timeout = self.server.keepalive
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def serve(self, ready):
+        """
+        Handle the requests the connection has ready, ready is when it was accepted or became
+        readable. Returns True when the connection is kept alive for the next request.
+        """
+        self.accepted = ready
+        self.close_connection = 0
+        while True:
+            self.handle_one_request()
+            if self.close_connection:
+                return False
+            if not self.buffered():
+                return True
+
+    def buffered(self):
+        """
+        True when pipelined requests are already in the file buffer, poll() cannot see them
+        """
+        return bool(self.rfile._rbuf.getvalue())
+
+    def close(self):
+        try:
+            self.finish()
+        except socket.error:
+            pass
+        try:
+            self.connection.close()
+        except socket.error:
+            pass
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+            self.request_start = self.accepted or time.time()
+            self.accepted = None
+            if len(self.raw_requestline) > 65536:
+                self.requestline = ''
+                self.request_version = ''
+                self.command = ''
+                self.send_error(414)
+                return
+            if not self.raw_requestline:
+                self.close_connection = 1
+                return
+            if not self.parse_request():
+                return
+            self.run_application()
+            self.wfile.flush()
+        except socket.timeout:
+            self.close_connection = 1
+        except socket.error, e:
+            if e.args[0] not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+            self.close_connection = 1
+
+    def environ(self):
+        path, _, query = self.path.partition('?')
+        environ = dict(self.server.base_environ)
+        environ.update({
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': self.headers.get('content-type', ''),
+            'CONTENT_LENGTH': '',
+            'REMOTE_ADDR': self.client_address[0],
+            'SERVER_PROTOCOL': self.request_version,
+            'wsgi.errors': sys.stderr,
+            'wsgi.file_wrapper': FileWrapper,
+            'backstage.request_start': self.request_start,
+        })
+
+        for name in self.headers.keys():
+            key = name.replace('-', '_').upper()
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                continue
+            environ['HTTP_' + key] = ','.join(self.headers.getheaders(name))
+
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            from StringIO import StringIO
+            body = read_chunked(self.rfile)
+            environ['CONTENT_LENGTH'] = str(len(body))
+            environ['wsgi.input'] = self.input = InputStream(StringIO(body), len(body))
+        else:
+            length = self.headers.get('content-length', '')
+            environ['CONTENT_LENGTH'] = length
+            environ['wsgi.input'] = self.input = InputStream(self.rfile, int(length) if length.isdigit() else 0)
+        return environ
+
+    def run_application(self):
+        if self.headers.get('expect', '').lower() == '100-continue' and self.request_version == 'HTTP/1.1':
+            self.wfile.write("HTTP/1.1 100 Continue\r\n\r\n")
+
+        environ = self.environ()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if response.get('sent'):
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            response['status'] = status
+            response['headers'] = headers
+            return self.wfile.write
+
+        try:
+            result = self.server.application(environ, start_response)
+        except Exception:
+            logger.exception("Unhandled error in the application")
+            self.close_connection = 1
+            self.send_error(500)
+            return
+
+        # Counted before the headers go out, the response that reaches max_requests says Connection: close
+        self.server.request_done()
+        try:
+            self.write_response(response, result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            self.input.drain()
+
+    def write_response(self, response, result):
+        chunks = iter(result)
+        first = ''
+        for first in chunks:
+            if first:
+                break
+
+        # A body that fits in one chunk gets a Content-Length, anything else is sent chunked
+        # so the connection can stay open
+        rest = None
+        for chunk in chunks:
+            if chunk:
+                rest = chunk
+                break
+
+        status = response['status']
+        headers = list(response['headers'])
+        names = set(name.lower() for name, value in headers)
+        chunked = False
+        if 'content-length' not in names:
+            if rest is None:
+                headers.append(('Content-Length', str(len(first))))
+            elif self.request_version == 'HTTP/1.1':
+                headers.append(('Transfer-Encoding', 'chunked'))
+                chunked = True
+            else:
+                self.close_connection = 1
+
+        if self.close_connection or self.server.stopping:
+            self.close_connection = 1
+            headers.append(('Connection', 'close'))
+        elif self.request_version == 'HTTP/1.0':
+            headers.append(('Connection', 'keep-alive'))
+
+        code = status.split(' ', 1)[0]
+        self.wfile.write("%s %s\r\n" % (self.protocol_version, status))
+        self.wfile.write("Server: %s\r\nDate: %s\r\n" % (self.server_version, self.date_time_string()))
+        for name, value in headers:
+            self.wfile.write("%s: %s\r\n" % (name, value))
+        self.wfile.write("\r\n")
+        response['sent'] = True
+
+        if self.command != 'HEAD':
+            write = self.write_chunk if chunked else self.wfile.write
+            if first:
+                write(first)
+            if rest is not None:
+                write(rest)
+                for chunk in chunks:
+                    if chunk:
+                        write(chunk)
+            if chunked:
+                self.wfile.write("0\r\n\r\n")
+
+        self.log_request(code)
+
+    def write_chunk(self, data):
+        self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+
+    def log_message(self, format, *args):
+        logger.info("%s - - %s" % (self.client_address[0], format % args))
+
+
+class Worker(object):
+    """
+    A forked worker, connections are accepted into a bounded queue served by a pool of threads
+    """
+
+    def __init__(self, sock, application, threads, max_requests, keepalive):
+        self.socket = sock
+        self.application = application
+        self.threads = threads
+        self.keepalive = keepalive
+        # Spread the recycling so the workers do not all restart at once
+        self.max_requests = max_requests + random.randint(0, max_requests // 10) if max_requests else 0
+        self.handled = 0
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.queue = Queue.Queue(threads)
+        # Kept alive connections waiting for their next request, by file descriptor, the ones
+        # the threads handed back since the accept loop last woke up and the connections
+        # queued or being served
+        self.idle = {}
+        self.parked = []
+        self.busy = 0
+        self.wakeup = os.pipe()
+
+        host, port = sock.getsockname()[:2]
+        self.base_environ = {
+            'SERVER_NAME': socket.getfqdn(host),
+            'SERVER_PORT': str(port),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            # Used by the memory accounting to recycle a worker that grew too large
+            'backstage.recycle': self.stop,
+        }
+
+    def request_done(self):
+        with self.lock:
+            self.handled += 1
+            if self.max_requests and self.handled >= self.max_requests and not self.stopping:
+                logger.info("Worker %s served %s requests, recycling" % (os.getpid(), self.handled))
+                self.stopping = True
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def serve_connections(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            handler, ready = item
+            try:
+                keep_alive = handler.serve(ready)
+            except Exception:
+                logger.exception("Error while handling a connection from %s" % (handler.client_address,))
+                keep_alive = False
+            # A connection whose last response did not say Connection: close gets one more request,
+            # even from a worker that is stopping
+            if keep_alive:
+                self.park(handler)
+            else:
+                handler.close()
+            with self.lock:
+                self.busy -= 1
+
+    def dispatch(self, handler, ready):
+        with self.lock:
+            self.busy += 1
+        # Blocks when every thread is busy
+        self.queue.put((handler, ready))
+
+    def park(self, handler):
+        """
+        Hand a kept alive connection back to the accept loop, so it does not hold a thread while idle
+        """
+        with self.lock:
+            self.parked.append(handler)
+        try:
+            os.write(self.wakeup[1], '.')
+        except OSError, e:
+            # The pipe is full, the accept loop wakes up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def accept(self):
+        try:
+            connection, address = self.socket.accept()
+            accepted = time.time()
+        except socket.error, e:
+            # Another worker got the connection first
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNABORTED):
+                return
+            raise
+        connection.setblocking(1)
+        # While every thread is busy the next connections wait in the backlog where another
+        # worker can pick them up
+        self.dispatch(WSGIRequestHandler(connection, address, self), accepted)
+
+    def watch_parked(self, poller, now):
+        try:
+            os.read(self.wakeup[0], 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        with self.lock:
+            parked, self.parked = self.parked, []
+        for handler in parked:
+            fd = handler.connection.fileno()
+            self.idle[fd] = (handler, now)
+            poller.register(fd, select.POLLIN)
+
+    def close_expired(self, poller, now):
+        for fd, (handler, since) in self.idle.items():
+            if now - since >= self.keepalive:
+                poller.unregister(fd)
+                del self.idle[fd]
+                handler.close()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.socket.setblocking(0)
+        for fd in self.wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        pool = [threading.Thread(target=self.serve_connections) for _ in range(self.threads)]
+        for thread in pool:
+            thread.daemon = True
+            thread.start()
+
+        # Only this thread registers file descriptors, poll objects are not thread safe
+        poller = select.poll()
+        poller.register(self.socket, select.POLLIN)
+        poller.register(self.wakeup[0], select.POLLIN)
+        listening = self.socket.fileno()
+        swept = time.time()
+
+        while True:
+            if self.stopping:
+                if listening is not None:
+                    # New connections go to the other workers, the kept alive ones still get their
+                    # next request answered with Connection: close, or expire
+                    poller.unregister(listening)
+                    listening = None
+                with self.lock:
+                    if not self.idle and not self.parked and not self.busy:
+                        break
+            try:
+                events = poller.poll(1000)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            now = time.time()
+            for fd, event in events:
+                if fd == listening:
+                    self.accept()
+                elif fd == self.wakeup[0]:
+                    self.watch_parked(poller, now)
+                else:
+                    # The next request arrived, or the client closed the connection
+                    poller.unregister(fd)
+                    handler, since = self.idle.pop(fd)
+                    self.dispatch(handler, now)
+            if now - swept >= 1:
+                swept = now
+                self.close_expired(poller, now)
+
+        for thread in pool:
+            self.queue.put(None)
+        for thread in pool:
+            thread.join()
+        for handler, since in self.idle.values():
+            handler.close()
+        for handler in self.parked:
+            handler.close()
+
+
+def listen(host, port, backlog, reuse_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+class Master(object):
+    def __init__(self, host, port, application, workers=2, threads=8, max_requests=0, keepalive=5,
+                 reuse_port=False, backlog=1024, graceful_timeout=30):
+        self.host = host
+        self.port = port
+        self.application = application
+        self.workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.keepalive = keepalive
+        self.reuse_port = reuse_port and SO_REUSEPORT is not None
+        self.backlog = backlog
+        self.graceful_timeout = graceful_timeout
+        self.children = {}
+        self.running = True
+        self.socket = None
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return
+
+        # In the worker
+        exit_code = 0
+        try:
+            sock = self.socket
+            if self.reuse_port:
+                sock = listen(self.host, self.port, self.backlog, True)
+            Worker(sock, self.application, self.threads, self.max_requests, self.keepalive).run()
+        except Exception:
+            logger.exception("Worker %s failed" % os.getpid())
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def stop(self, *args):
+        self.running = False
+
+    def run(self):
+        if self.reuse_port:
+            # Fail early if the address cannot be bound, the workers bind their own sockets
+            listen(self.host, self.port, self.backlog, True).close()
+        else:
+            self.socket = listen(self.host, self.port, self.backlog, False)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for _ in range(self.workers):
+            self.spawn()
+
+        while self.running:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            started = self.children.pop(pid, None)
+            # A worker killed in the middle of a request leaves its requests counted
+            governor.reap(pid)
+            if started is None or not self.running:
+                continue
+            if time.time() - started < 1:
+                # A worker that dies right away would otherwise be restarted in a tight loop
+                time.sleep(1)
+            self.spawn()
+
+        self.shutdown()
+
+    def shutdown(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if pid:
+                self.children.pop(pid, None)
+                governor.reap(pid)
+            else:
+                time.sleep(0.1)
+
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
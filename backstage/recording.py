@@ -0,0 +1,182 @@
+"""
+Traffic recording for realistic performance testing.
+
+Add RecordingProcessor to REQUEST_PROCESSORS to write a sample of the requests
+( WSGI environ, body, matched API and timings ) to an append-only binary log.
+Every worker writes its own log from a background thread so the request path
+never waits on the disk. The logs are fed back with backstage_replay.
+
+Each record is a 4 byte big endian length followed by a marshal dump of
+(started, duration, api name, environ, body).
+"""
+
+import atexit
+import logging
+import marshal
+import os
+import random
+import struct
+import threading
+import time
+import Queue
+
+logger = logging.getLogger('backstage')
+
+HEADER = struct.Struct('!I')
+
+# Environ keys that are worth replaying, everything else is server specific
+ENVIRON_KEYS = ('REQUEST_METHOD', 'PATH_INFO', 'QUERY_STRING', 'CONTENT_TYPE', 'CONTENT_LENGTH',
+                'SCRIPT_NAME', 'SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL', 'REMOTE_ADDR')
+
+# Headers about the original connection or its timing, a replay has its own. A recorded
+# X-Request-Start would make every replayed request look like it waited in a queue.
+UNREPLAYED_KEYS = frozenset(['HTTP_X_REQUEST_START', 'HTTP_TRANSFER_ENCODING', 'HTTP_CONNECTION',
+                             'HTTP_KEEP_ALIVE', 'HTTP_TE', 'HTTP_UPGRADE'])
+
+REDACTED = 'redacted'
+
+
+def redacted_keys(headers):
+    """
+    Environ keys of the header names in RECORD_REDACT_HEADERS
+    """
+    return frozenset('HTTP_' + name.upper().replace('-', '_') for name in headers)
+
+
+class RecordWriter(object):
+    def __init__(self, path, max_bytes, backup_count, queue_size):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.log_file = None
+        self.thread = threading.Thread(target=self.run, name='backstage-recorder')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, record):
+        """
+        Never blocks, records are dropped when the writer cannot keep up
+        """
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning("Recorder queue is full, %s records dropped so far" % self.dropped)
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.log_file = open(self.path, 'ab')
+
+    def rotate(self):
+        self.log_file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = "%s.%d" % (self.path, index)
+            if os.path.exists(source):
+                os.rename(source, "%s.%d" % (self.path, index + 1))
+        if self.backup_count:
+            os.rename(self.path, "%s.1" % self.path)
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def run(self):
+        self.open()
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            data = marshal.dumps(record, 2)
+            self.log_file.write(HEADER.pack(len(data)))
+            self.log_file.write(data)
+            if self.queue.empty():
+                self.log_file.flush()
+            if self.log_file.tell() >= self.max_bytes:
+                self.rotate()
+        self.log_file.close()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(5)
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """
+    One writer per worker, each worker logs to its own file
+    """
+    global _writer, _writer_pid
+    from conf.settings import RECORD_DIRECTORY, RECORD_MAX_BYTES, RECORD_BACKUP_COUNT, RECORD_QUEUE_SIZE
+
+    with _writer_lock:
+        if _writer_pid != os.getpid():
+            path = os.path.join(RECORD_DIRECTORY, "requests-%d.rec" % os.getpid())
+            _writer = RecordWriter(path, RECORD_MAX_BYTES, RECORD_BACKUP_COUNT, RECORD_QUEUE_SIZE)
+            _writer_pid = os.getpid()
+    return _writer
+
+
+def replayable(environ):
+    """
+    The recorded environ without the connection and timing headers, logs written before they
+    were left out still have them
+    """
+    return dict((key, value) for key, value in environ.iteritems() if key not in UNREPLAYED_KEYS)
+
+
+def read_records(path):
+    """
+    Yields (started, duration, api name, environ, body) from a log file
+    """
+    with open(path, 'rb') as log_file:
+        while True:
+            header = log_file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, = HEADER.unpack(header)
+            data = log_file.read(length)
+            if len(data) < length:
+                # The last record of a log that is still being written
+                return
+            yield marshal.loads(data)
+
+
+class RecordingProcessor(object):
+    """
+    Request processor that records RECORD_SAMPLE_RATE of the requests
+    """
+
+    def pre_process(self, request):
+        from conf.settings import RECORD_SAMPLE_RATE, RECORD_REDACT_HEADERS
+
+        if RECORD_SAMPLE_RATE < 1 and random.random() >= RECORD_SAMPLE_RATE:
+            return
+        environ = request.headers.environ
+        recorded = dict((key, environ[key]) for key in environ
+                        if (key in ENVIRON_KEYS or key.startswith('HTTP_')) and key not in UNREPLAYED_KEYS
+                        and isinstance(environ[key], str))
+        # Credentials never reach the disk
+        for key in redacted_keys(RECORD_REDACT_HEADERS):
+            if key in recorded:
+                recorded[key] = REDACTED
+        # Read the body before the sequences get to stream it
+        body = request.body if hasattr(request, 'input') else ''
+        request.recording = (time.time(), recorded, body)
+
+    def post_process(self, request):
+        recording = getattr(request, 'recording', None)
+        if recording is None:
+            return
+        started, environ, body = recording
+        api = getattr(request, 'api', None)
+        get_writer().write((started, time.time() - started, api.name if api else None, environ, body))
@@ -0,0 +1,251 @@
+"""
+backstage_replay - feed recorded traffic back into backstage.
+
+    backstage_replay run <log-files-or-directories> --xml <xml-file-or-directory> --settings <path>
+    backstage_replay run <log-files-or-directories> --url http://127.0.0.1:8011 --speed 2 --report new.json
+    backstage_replay compare old.json new.json
+
+The requests are replayed in process through core.application or against a
+running server, at the recorded pace divided by --speed ( 0 replays as fast as
+possible ). The report holds throughput and latency figures which can be
+compared between two builds or two XML configurations.
+"""
+
+import argparse
+import heapq
+import httplib
+import json
+import os
+import sys
+import threading
+import time
+import urlparse
+import Queue
+from StringIO import StringIO
+
+from recording import read_records, replayable
+
+
+def log_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if '.rec' in name)
+        else:
+            files.append(path)
+    return files
+
+
+def records(paths):
+    """
+    Records of all the worker logs merged in the order they were received
+    """
+    return heapq.merge(*[read_records(path) for path in log_files(paths)])
+
+
+class InProcessTarget(object):
+    def __init__(self):
+        from core import application
+        self.application = application
+
+    def send(self, environ, body):
+        environ = replayable(environ)
+        environ.update({'wsgi.input': StringIO(body), 'wsgi.errors': sys.stderr, 'wsgi.url_scheme': 'http',
+                        'wsgi.version': (1, 0), 'wsgi.multithread': True, 'wsgi.multiprocess': False,
+                        'wsgi.run_once': False})
+        status = []
+
+        def start_response(response_status, headers, exc_info=None):
+            status.append(response_status)
+
+        result = self.application(environ, start_response)
+        for chunk in result:
+            pass
+        if hasattr(result, 'close'):
+            result.close()
+        return int(status[0].split(' ', 1)[0])
+
+
+class HTTPTarget(object):
+    def __init__(self, url):
+        parsed = urlparse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.local = threading.local()
+
+    def send(self, environ, body):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = httplib.HTTPConnection(self.host, self.port, timeout=60)
+
+        path = environ.get('PATH_INFO', '/')
+        if environ.get('QUERY_STRING'):
+            path = "%s?%s" % (path, environ['QUERY_STRING'])
+        headers = dict((key[5:].replace('_', '-').title(), value) for key, value in replayable(environ).items()
+                       if key.startswith('HTTP_') and key != 'HTTP_HOST')
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+        try:
+            connection.request(environ.get('REQUEST_METHOD', 'GET'), path, body or None, headers)
+            response = connection.getresponse()
+            response.read()
+        except (httplib.HTTPException, IOError):
+            connection.close()
+            self.local.connection = None
+            raise
+        return response.status
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda fraction: values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+    return {'mean': sum(values) / len(values) * 1000, 'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99),
+            'max': values[-1] * 1000}
+
+
+def replay_records(target, stream, speed, concurrency):
+    queue = Queue.Queue(concurrency * 2)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            recorded_duration, api_name, environ, body = item
+            started = time.time()
+            try:
+                status = target.send(environ, body)
+            except Exception:
+                status = None
+            with lock:
+                results.append((api_name, status, time.time() - started, recorded_duration))
+
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    replay_started = time.time()
+    first_started = None
+    for started, duration, api_name, environ, body in stream:
+        if first_started is None:
+            first_started = started
+        if speed:
+            delay = replay_started + (started - first_started) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        queue.put((duration, api_name, environ, body))
+
+    for thread in workers:
+        queue.put(None)
+    for thread in workers:
+        thread.join()
+    return results, time.time() - replay_started
+
+
+def build_report(results, elapsed):
+    latencies = [result[2] for result in results]
+    statuses = {}
+    apis = {}
+    for api_name, status, latency, recorded in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        apis.setdefault(str(api_name), []).append(latency)
+    return {
+        'requests': len(results),
+        'errors': sum(1 for result in results if result[1] is None or result[1] >= 500),
+        'elapsed': elapsed,
+        'throughput': len(results) / elapsed if elapsed else 0,
+        'latency': percentiles(latencies),
+        'recorded_latency': percentiles([result[3] for result in results]),
+        'status': statuses,
+        'apis': dict((name, dict(percentiles(values), requests=len(values))) for name, values in apis.items()),
+    }
+
+
+def print_report(report):
+    print "Requests: %(requests)d  Errors: %(errors)d  Elapsed: %(elapsed).2fs  Throughput: %(throughput).1f req/s" % report
+    for title, key in (('Latency (ms)', 'latency'), ('Recorded latency (ms)', 'recorded_latency')):
+        if report[key]:
+            print "%-22s" % title,
+            print "mean %(mean)8.2f  p50 %(p50)8.2f  p90 %(p90)8.2f  p99 %(p99)8.2f  max %(max)8.2f" % report[key]
+    print "Status: %s" % ", ".join("%s=%s" % item for item in sorted(report['status'].items()))
+
+
+def compare_reports(baseline, candidate):
+    def change(old, new):
+        if not old:
+            return '     n/a'
+        return '%+7.1f%%' % ((new - old) * 100.0 / old)
+
+    print "%-24s %12s %12s %9s" % ('', 'baseline', 'candidate', 'change')
+    rows = [('throughput (req/s)', baseline['throughput'], candidate['throughput'])]
+    for key in ('mean', 'p50', 'p90', 'p99', 'max'):
+        rows.append(('latency %s (ms)' % key, baseline['latency'].get(key, 0), candidate['latency'].get(key, 0)))
+    rows.append(('errors', baseline['errors'], candidate['errors']))
+    for title, old, new in rows:
+        print "%-24s %12.2f %12.2f %9s" % (title, old, new, change(old, new))
+
+    print
+    print "%-24s %12s %12s %9s" % ('p99 per api (ms)', 'baseline', 'candidate', 'change')
+    for name in sorted(set(baseline['apis']) | set(candidate['apis'])):
+        old = baseline['apis'].get(name, {}).get('p99', 0)
+        new = candidate['apis'].get(name, {}).get('p99', 0)
+        print "%-24s %12.2f %12.2f %9s" % (name, old, new, change(old, new))
+
+
+def load_settings(settings_path):
+    if settings_path:
+        sys.path.extend(settings_path.split(","))
+        __import__('settings')
+
+
+def replay():
+    parser = argparse.ArgumentParser(description='Replay recorded backstage traffic')
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='Replay recorded logs')
+    run_parser.add_argument('logs', nargs='+', help='Recorded log files or directories')
+    run_parser.add_argument('--xml', default='', type=str,
+                            help='Directory/File to be parsed, the requests are sent to core.application')
+    run_parser.add_argument('--url', default='', type=str, help='Send the requests to a running server')
+    run_parser.add_argument('--settings', default='', type=str, help='Settings file for the backstage server to use')
+    run_parser.add_argument('--speed', default=1.0, type=float,
+                            help='1 replays at the recorded pace, 2 twice as fast, 0 as fast as possible')
+    run_parser.add_argument('--concurrency', default=8, type=int, help='Requests sent at the same time')
+    run_parser.add_argument('--report', default='', type=str, help='Write the report as JSON to this file')
+
+    compare_parser = commands.add_parser('compare', help='Compare two reports')
+    compare_parser.add_argument('baseline', type=str)
+    compare_parser.add_argument('candidate', type=str)
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.baseline) as baseline, open(args.candidate) as candidate:
+            compare_reports(json.load(baseline), json.load(candidate))
+        return
+
+    if bool(args.xml) == bool(args.url):
+        parser.error("Either --xml or --url has to be given")
+
+    if args.xml:
+        load_settings(args.settings)
+        import logging
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('backstage').setLevel(logging.WARNING)
+        from core import load
+        load(args.xml)
+        target = InProcessTarget()
+    else:
+        target = HTTPTarget(args.url)
+
+    results, elapsed = replay_records(target, records(args.logs), args.speed, args.concurrency)
+    report = build_report(results, elapsed)
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
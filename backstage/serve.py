@@ -26,8 +26,12 @@ class GunicornServer(object):
     def run(self, application):
         from gunicorn.app.base import Application
 
+        from backstage.governor import governor
+
         options = {'bind': "%s:%d" % (self.host, self.port)}
         options.update(self.options)
+        # Zero the admission control counts of a worker killed in the middle of a request
+        options.setdefault('child_exit', lambda server, worker: governor.reap(worker.pid))
 
         class GunicornApplication(Application):
             def init(self, parser, opts, args):
@@ -41,7 +45,36 @@ class GunicornServer(object):
 
         GunicornApplication().run()
 
-servers = {'simple': SimpleServer, 'gunicorn': GunicornServer}
+class PreforkServer(object):
+    """
+    Options: workers, threads ( per worker ), max_requests ( recycle a worker after that many
+    requests, 0 never ), keepalive ( seconds ), reuse_port, backlog and graceful_timeout
+    """
+
+    int_options = ('workers', 'threads', 'max_requests', 'keepalive', 'backlog', 'graceful_timeout')
+
+    def __init__(self, host, port, **options):
+        self.host = host
+        self.port = port
+        self.options = {}
+        for option, value in options.iteritems():
+            if option in self.int_options:
+                value = int(value)
+            elif option == 'reuse_port':
+                value = value.lower() in ('1', 'true', 'yes')
+            else:
+                raise ValueError("Unknown option %s for the prefork server" % option)
+            self.options[option] = value
+
+    def run(self, application):
+        from backstage.prefork import Master
+
+        master = Master(self.host, self.port, application, **self.options)
+        print "Starting backstage prefork server with %s workers @ %s" % (master.workers, self.port)
+        print "Press Ctrl + C to exit"
+        master.run()
+
+servers = {'simple': SimpleServer, 'gunicorn': GunicornServer, 'prefork': PreforkServer}
 
 def serve():
     parser = argparse.ArgumentParser(description='Run backstage server with various options')
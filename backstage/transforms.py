@@ -0,0 +1,52 @@
+"""
+Precompiled XPath and XSLT transformations for the transform mediator.
+
+Compiled expressions and stylesheets are cached by their text ( or path )
+so the same expression used by several mediators is compiled once.
+"""
+
+import threading
+
+from lxml import etree
+
+_xpaths = {}
+_xslts = {}
+_parsers = threading.local()
+
+
+def compile_xpath(expression, namespaces=None):
+    key = (expression, tuple(sorted((namespaces or {}).items())))
+    xpath = _xpaths.get(key)
+    if xpath is None:
+        xpath = _xpaths[key] = etree.XPath(expression, namespaces=namespaces, smart_strings=False)
+    return xpath
+
+
+def compile_xslt(path):
+    xslt = _xslts.get(path)
+    if xslt is None:
+        xslt = _xslts[path] = etree.XSLT(etree.parse(path))
+    return xslt
+
+
+def parse_xml(value):
+    """
+    Parse a body into an element, entities are not resolved and nothing is fetched from the network
+    """
+    if isinstance(value, (etree._Element, etree._ElementTree)):
+        return value
+    parser = getattr(_parsers, 'parser', None)
+    if parser is None:
+        parser = _parsers.parser = etree.XMLParser(resolve_entities=False, no_network=True)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return etree.fromstring(value, parser)
+
+
+def xpath_result(result):
+    """
+    Elements are serialised, strings, numbers and booleans are kept as they are
+    """
+    if isinstance(result, list):
+        return [etree.tostring(item) if isinstance(item, etree._Element) else item for item in result]
+    return result
@@ -0,0 +1,242 @@
+"""
+Request validation for the validate mediator.
+
+A spec has optional "headers", "query" and "body" sections written in a subset
+of JSON Schema: type, enum, minLength, maxLength, pattern, minimum, maximum,
+exclusiveMinimum, exclusiveMaximum, items, minItems, maxItems, properties,
+required and additionalProperties. Headers and query parameters are strings,
+they are converted before integer, number and boolean checks.
+
+The spec is compiled once into closures, validating a request only runs them.
+Every validator appends {"field": ..., "message": ...} errors to a list.
+"""
+
+import re
+
+import core_exceptions
+
+
+class SchemaError(Exception):
+    pass
+
+
+TYPES = {
+    'string': lambda value: isinstance(value, basestring),
+    'integer': lambda value: isinstance(value, (int, long)) and not isinstance(value, bool),
+    'number': lambda value: isinstance(value, (int, long, float)) and not isinstance(value, bool),
+    'boolean': lambda value: isinstance(value, bool),
+    'object': lambda value: isinstance(value, dict),
+    'array': lambda value: isinstance(value, list),
+    'null': lambda value: value is None,
+}
+
+BOOLEANS = {'true': True, '1': True, 'false': False, '0': False}
+
+
+def _to_boolean(value):
+    return BOOLEANS[value.lower()]
+
+
+# Conversions of header and query strings
+COERCIONS = {'integer': int, 'number': float, 'boolean': _to_boolean}
+
+
+def _type_check(types, coerce):
+    """
+    Returns a function of the value giving ( matches, value ), the value converted if it had to be
+    """
+    if isinstance(types, basestring):
+        types = [types]
+    for name in types:
+        if name not in TYPES:
+            raise SchemaError("Unknown type %s " % name)
+    tests = [TYPES[name] for name in types]
+    coercions = [COERCIONS[name] for name in types if coerce and name in COERCIONS]
+
+    def check(value):
+        for test in tests:
+            if test(value):
+                return True, value
+        if coercions and isinstance(value, basestring):
+            for coercion in coercions:
+                try:
+                    return True, coercion(value)
+                except (KeyError, ValueError):
+                    pass
+        return False, value
+    return check
+
+
+def _enum(schema, coerce):
+    allowed = schema['enum']
+    try:
+        allowed = frozenset(allowed)
+    except TypeError:
+        pass
+    # Keep the message short for large lists of values
+    message = "must be one of %s" % ', '.join(map(unicode, schema['enum'][:10]))
+
+    def check(value, path, errors):
+        try:
+            found = value in allowed
+        except TypeError:
+            found = False
+        if not found:
+            errors.append({'field': path, 'message': message})
+    return check
+
+
+def _string(schema, coerce):
+    min_length = schema.get('minLength')
+    max_length = schema.get('maxLength')
+    pattern = re.compile(schema['pattern']) if 'pattern' in schema else None
+
+    def check(value, path, errors):
+        if not isinstance(value, basestring):
+            return
+        if min_length is not None and len(value) < min_length:
+            errors.append({'field': path, 'message': "must be at least %s characters long" % min_length})
+        if max_length is not None and len(value) > max_length:
+            errors.append({'field': path, 'message': "must be at most %s characters long" % max_length})
+        if pattern is not None and not pattern.search(value):
+            errors.append({'field': path, 'message': "must match %s" % pattern.pattern})
+    return check
+
+
+def _number(schema, coerce):
+    bounds = []
+    for keyword, test, message in (
+            ('minimum', lambda value, bound: value >= bound, "must be at least %s"),
+            ('maximum', lambda value, bound: value <= bound, "must be at most %s"),
+            ('exclusiveMinimum', lambda value, bound: value > bound, "must be more than %s"),
+            ('exclusiveMaximum', lambda value, bound: value < bound, "must be less than %s")):
+        if keyword in schema:
+            bounds.append((schema[keyword], test, message % schema[keyword]))
+
+    def check(value, path, errors):
+        if not TYPES['number'](value):
+            return
+        for bound, test, message in bounds:
+            if not test(value, bound):
+                errors.append({'field': path, 'message': message})
+    return check
+
+
+def _array(schema, coerce):
+    min_items = schema.get('minItems')
+    max_items = schema.get('maxItems')
+    items = compile_schema(schema['items'], coerce) if 'items' in schema else None
+
+    def check(value, path, errors):
+        if not isinstance(value, list):
+            return
+        if min_items is not None and len(value) < min_items:
+            errors.append({'field': path, 'message': "must have at least %s items" % min_items})
+        if max_items is not None and len(value) > max_items:
+            errors.append({'field': path, 'message': "must have at most %s items" % max_items})
+        if items is not None:
+            for index, item in enumerate(value):
+                items(item, "%s.%d" % (path, index), errors)
+    return check
+
+
+def _object(schema, coerce):
+    properties = [(name, compile_schema(property_schema, coerce))
+                  for name, property_schema in schema.get('properties', {}).items()]
+    required = list(schema.get('required', []))
+    additional = schema.get('additionalProperties', True)
+    known = frozenset(schema.get('properties', {}))
+    additional_schema = compile_schema(additional, coerce) if isinstance(additional, dict) else None
+
+    def check(value, path, errors):
+        if not isinstance(value, dict):
+            return
+        for name in required:
+            if name not in value:
+                errors.append({'field': "%s.%s" % (path, name), 'message': "is required"})
+        for name, validate in properties:
+            if name in value:
+                validate(value[name], "%s.%s" % (path, name), errors)
+        if additional is not True:
+            for name in value:
+                if name in known:
+                    continue
+                if additional_schema is None:
+                    errors.append({'field': "%s.%s" % (path, name), 'message': "is not allowed"})
+                else:
+                    additional_schema(value[name], "%s.%s" % (path, name), errors)
+    return check
+
+
+# The checks that apply, given the keywords found in a schema
+KEYWORDS = (
+    (('enum',), _enum),
+    (('minLength', 'maxLength', 'pattern'), _string),
+    (('minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum'), _number),
+    (('items', 'minItems', 'maxItems'), _array),
+    (('properties', 'required', 'additionalProperties'), _object),
+)
+
+
+def compile_schema(schema, coerce=False):
+    """
+    Compile a schema into a function of ( value, path, errors )
+    """
+    if not isinstance(schema, dict):
+        raise SchemaError("A schema has to be an object, got %r " % (schema,))
+
+    type_check = None
+    expected = None
+    if 'type' in schema:
+        type_check = _type_check(schema['type'], coerce)
+        expected = schema['type'] if isinstance(schema['type'], basestring) else ' or '.join(schema['type'])
+    checks = [factory(schema, coerce) for keywords, factory in KEYWORDS
+              if any(keyword in schema for keyword in keywords)]
+
+    def validate(value, path, errors):
+        if type_check is not None:
+            matches, value = type_check(value)
+            if not matches:
+                # The other keywords would only repeat the same mistake
+                errors.append({'field': path, 'message': "must be of type %s" % expected})
+                return
+        for check in checks:
+            check(value, path, errors)
+    return validate
+
+
+def compile_spec(spec):
+    """
+    Compile a spec with "headers", "query" and "body" sections into a function of the request
+    returning the list of errors
+    """
+    unknown = set(spec) - set(['headers', 'query', 'body'])
+    if unknown:
+        raise SchemaError("Unknown sections %s in the validation spec " % ', '.join(sorted(unknown)))
+
+    headers = query = body = None
+    if 'headers' in spec:
+        # Requests always carry more headers than the spec knows about
+        section = dict(spec['headers'], type='object')
+        section.pop('additionalProperties', None)
+        headers = compile_schema(section, coerce=True)
+    if 'query' in spec:
+        query = compile_schema(dict(spec['query'], type='object'), coerce=True)
+    if 'body' in spec:
+        body = compile_schema(spec['body'])
+
+    def validate(request):
+        errors = []
+        if headers is not None:
+            headers(request.headers, 'header', errors)
+        if query is not None:
+            query(request.GET, 'query', errors)
+        if body is not None:
+            try:
+                data = request.data
+            except core_exceptions.Raise400Exception, e:
+                errors.append({'field': 'body', 'message': str(e)})
+            else:
+                body(data, 'body', errors)
+        return errors
+    return validate
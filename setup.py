@@ -17,6 +17,7 @@ setup(
         entry_points={
             'console_scripts': [
                 'backstage_serve = backstage.serve:serve',
+                'backstage_replay = backstage.replay:replay',
                 ]
         },
      )
@@ -0,0 +1,127 @@
+"""
+The call mediator's HTTP client against a stub backend.
+
+Run with python -m unittest discover -s tests -t .
+"""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import unittest
+
+from backstage import core_exceptions, expressions, http_client
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, body):
+        self.server.requests.append((self.command, self.path, self.client_address[1]))
+        if self.path == '/slow':
+            time.sleep(0.5)
+        if self.path == '/big':
+            body = 'x' * 100
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/stale':
+            # Closes the connection without telling the client, as a server timing out an idle one
+            self.close_connection = 1
+
+    def do_GET(self):
+        self.respond('ok')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        self.respond('posted')
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def process_request(self, request, client_address):
+        # Handler threads are kept so the test can wait for them
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        self.threads.append(thread)
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # The client gave up on a slow response
+        pass
+
+
+class CallTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        self.server.requests = []
+        self.server.threads = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        http_client._pools = {}
+
+    def tearDown(self):
+        for pool in http_client._pools.values():
+            for connection, released_at in pool.idle:
+                connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        for thread in self.server.threads:
+            thread.join(2)
+
+    def test_connection_is_reused(self):
+        for _ in range(3):
+            status, reason, headers, body = http_client.request('GET', self.base + '/ok')
+            self.assertEqual((status, body), (200, 'ok'))
+        self.assertEqual(len(set(port for method, path, port in self.server.requests)), 1)
+
+    def test_pool_size_limit(self):
+        pool = http_client.ConnectionPool('http', '127.0.0.1', self.server.server_address[1], 1, 60)
+        connection, reused = pool.acquire(1)
+        self.assertRaises(core_exceptions.PoolExhaustedException, pool.acquire, 0.2)
+        pool.release(connection)
+        self.assertEqual(pool.acquire(0.2), (connection, True))
+
+    def test_read_timeout(self):
+        self.assertRaises(core_exceptions.CallTimeoutException,
+                          http_client.request, 'GET', self.base + '/slow', read_timeout=0.1)
+
+    def test_deadline_caps_the_timeouts(self):
+        self.assertRaises(core_exceptions.CallTimeoutException,
+                          http_client.request, 'GET', self.base + '/slow', deadline=time.time() + 0.1)
+        self.assertRaises(core_exceptions.Raise504Exception,
+                          http_client.request, 'GET', self.base + '/ok', deadline=time.time() - 1)
+
+    def test_response_size_limit(self):
+        self.assertRaises(core_exceptions.ResponseTooLargeException,
+                          http_client.request, 'GET', self.base + '/big', max_response_size=50)
+
+    def test_stale_connection_retried_for_idempotent_methods(self):
+        http_client.request('GET', self.base + '/stale')
+        time.sleep(0.1)
+        status, reason, headers, body = http_client.request('GET', self.base + '/ok')
+        self.assertEqual((status, body), (200, 'ok'))
+
+    def test_stale_connection_not_retried_for_post(self):
+        http_client.request('GET', self.base + '/stale')
+        time.sleep(0.1)
+        self.assertRaises(core_exceptions.CallException,
+                          http_client.request, 'POST', self.base + '/ok', 'payload')
+        self.assertEqual([method for method, path, port in self.server.requests], ['GET'])
+
+    def test_endpoint_values_are_percent_encoded(self):
+        class Context(object):
+            user_id = u'../admin?all=1#x \xe9'
+        endpoint = expressions.compile_value(self.base + '/users/{$context.user_id}', 'url')
+        self.assertEqual(endpoint(Context()), self.base + '/users/..%2Fadmin%3Fall%3D1%23x%20%C3%A9')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+The switch mediator's case indexes against matching the cases one by one.
+
+Run with python -m unittest discover -s tests -t .
+"""
+
+import os
+import random
+import unittest
+
+from lxml import etree
+
+from backstage import core
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def build_switch(cases):
+    return core.build_handler(etree.fromstring('<switch expression="$context.key">%s</switch>' % cases), BASE_DIR)
+
+
+def linear_case(switch, key):
+    for position, case in enumerate(switch.cases):
+        if case.matches(key):
+            return position
+    return None
+
+
+class SwitchTest(unittest.TestCase):
+    def assertFirstMatch(self, switch, keys):
+        for key in keys:
+            self.assertEqual(switch.find_case(key), linear_case(switch, key), "key %r" % (key,))
+
+    def test_first_match_wins_across_indexes(self):
+        switch = build_switch('<case regex="a.*"/><case value="abc"/><case min="0" max="10"/>'
+                              '<case in="5,x1"/><case regex="x\\d"/><case regex="\\d+"/>')
+        self.assertEqual(switch.find_case('abc'), 0)
+        self.assertEqual(switch.find_case('5'), 2)
+        self.assertEqual(switch.find_case(5), 2)
+        self.assertEqual(switch.find_case('x1'), 3)
+        self.assertEqual(switch.find_case('x2'), 4)
+        self.assertEqual(switch.find_case('50'), 5)
+        self.assertEqual(switch.find_case('zzz'), None)
+        self.assertEqual(switch.find_case(None), None)
+        self.assertFirstMatch(switch, ['a', 'abc', '0', '10', '10.5', '-1', 'x1', 'x9', 'x10', '', 'b'])
+
+    def test_more_than_100_regex_groups(self):
+        cases = ''.join('<case regex="k%d-(\\d)(\\d)"/>' % index for index in range(120))
+        # Broad patterns in the last alternation lose to the specific ones before them and
+        # win over the ones after them
+        cases += '<case regex="k1.*"/>' + ''.join('<case regex="k2(\\d+)-\\d+"/>' for index in range(5))
+        switch = build_switch(cases)
+        self.assertTrue(len(switch.regexes) > 1)
+        for index in range(120):
+            self.assertEqual(switch.find_case('k%d-12' % index), index)
+        self.assertEqual(switch.find_case('k1-1'), 120)
+        self.assertEqual(switch.find_case('k15-123'), 120)
+        self.assertEqual(switch.find_case('k25-123'), 121)
+        keys = ['k%d-%d' % (random.randint(0, 130), random.randint(0, 1000)) for index in range(500)]
+        self.assertFirstMatch(switch, keys)
+
+    def test_backreferences_and_inline_flags(self):
+        switch = build_switch('<case regex="(\\w)\\1"/><case regex="(a)(b)"/><case regex="(?i)abc"/>'
+                              '<case regex="xyz"/><case regex="(?P&lt;name&gt;c)d"/><case regex="(?P&lt;name&gt;e)f"/>'
+                              '<case regex="(g)(?(1)h|i)"/>')
+        self.assertEqual(switch.find_case('aa'), 0)
+        self.assertEqual(switch.find_case('ab'), 1)
+        self.assertEqual(switch.find_case('ABC'), 2)
+        # The flag of one case does not apply to the others
+        self.assertEqual(switch.find_case('XYZ'), None)
+        self.assertEqual(switch.find_case('cd'), 4)
+        self.assertEqual(switch.find_case('ef'), 5)
+        self.assertEqual(switch.find_case('gh'), 6)
+        self.assertFirstMatch(switch, ['aa', 'bb', 'ab', 'abc', 'Abc', 'xyz', 'cd', 'ef', 'gh', 'gi', 'a'])
+
+    def test_range_bounds_are_included(self):
+        switch = build_switch('<case min="1" max="5"/><case min="5" max="10"/><case max="0"/>'
+                              '<case min="10"/><case min="3" max="3"/>')
+        expected = [(1, 0), (5, 0), (5.0001, 1), (10, 1), (10.5, 3), (0, 2), (-1, 2), (0.5, None),
+                    (3, 0), ('3', 0), ('not a number', None)]
+        for key, position in expected:
+            self.assertEqual(switch.find_case(key), position, "key %r" % (key,))
+        keys = [random.choice([-1, 0, 1, 3, 5, 10, 11]) + random.choice([0, 0.5, -0.5, 0.0001]) for index in range(500)]
+        self.assertFirstMatch(switch, keys)
+
+
+if __name__ == '__main__':
+    unittest.main()
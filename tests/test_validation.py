@@ -0,0 +1,117 @@
+"""
+The validate mediator's compiled specs.
+
+Run with python -m unittest discover -s tests -t .
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from backstage import core, validation
+
+SPEC = {
+    'headers': {'properties': {'x-count': {'type': 'integer', 'minimum': 1}, 'x-debug': {'type': 'boolean'}},
+                'required': ['x-count']},
+    'query': {'properties': {'page': {'type': 'integer'}, 'ratio': {'type': 'number', 'maximum': 1}},
+              'additionalProperties': False},
+    'body': {'type': 'object', 'required': ['name'], 'additionalProperties': False,
+             'properties': {'name': {'type': 'string'}, 'tags': {'type': 'array', 'items': {'type': 'string'}}}},
+}
+
+SERVICES = """<apis>
+  <api name="validated" context="^validated/$">
+    <resource method="POST">
+      <inSequence>
+        <switch expression="$header.x-kind">
+          <case value="strict">
+            <validate schema="spec.json"/>
+            <response value="created" status_code="201" status_message="Created"/>
+          </case>
+          <default><response value="created" status_code="201" status_message="Created"/></default>
+        </switch>
+      </inSequence>
+    </resource>
+  </api>
+</apis>
+"""
+
+
+def environ(method='POST', path='/', query='', body='', headers=None):
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query,
+               'CONTENT_LENGTH': str(len(body)), 'CONTENT_TYPE': 'application/json', 'wsgi.input': StringIO(body)}
+    environ.update(headers or {})
+    return environ
+
+
+def fields(errors):
+    return sorted(error['field'] for error in errors)
+
+
+class ValidationTest(unittest.TestCase):
+    def setUp(self):
+        self.validate = validation.compile_spec(SPEC)
+
+    def errors(self, **kwargs):
+        return self.validate(core.Request(environ(**kwargs)))
+
+    def test_valid_request(self):
+        self.assertEqual(self.errors(query='page=2&ratio=0.5', body='{"name": "a", "tags": ["b"]}',
+                                     headers={'HTTP_X_COUNT': '3', 'HTTP_X_DEBUG': 'true'}), [])
+
+    def test_headers_and_query_are_converted(self):
+        errors = self.errors(query='page=two&ratio=2', body='{"name": "a"}',
+                             headers={'HTTP_X_COUNT': '0', 'HTTP_X_DEBUG': 'maybe'})
+        self.assertEqual(fields(errors), ['header.x-count', 'header.x-debug', 'query.page', 'query.ratio'])
+        self.assertEqual(self.errors(query='page=1', body='{"name": "a"}', headers={'HTTP_X_COUNT': '1'}), [])
+
+    def test_required_and_additional_properties(self):
+        errors = self.errors(query='other=1', body='{"tags": [1], "extra": true}')
+        self.assertEqual(fields(errors), ['body.extra', 'body.name', 'body.tags.0', 'header.x-count', 'query.other'])
+        # Headers always allow more than the spec lists
+        self.assertEqual(self.errors(body='{"name": "a"}', headers={'HTTP_X_COUNT': '1', 'HTTP_X_OTHER': 'x'}), [])
+
+    def test_invalid_json_is_a_body_error(self):
+        errors = self.errors(body='{"name": ', headers={'HTTP_X_COUNT': '1'})
+        self.assertEqual(fields(errors), ['body'])
+
+    def test_unknown_sections_and_types_are_rejected(self):
+        self.assertRaises(validation.SchemaError, validation.compile_spec, {'cookies': {}})
+        self.assertRaises(validation.SchemaError, validation.compile_spec, {'body': {'type': 'text'}})
+
+
+class ValidateMediatorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'spec.json'), 'w') as spec_file:
+            json.dump({'body': SPEC['body']}, spec_file)
+        with open(os.path.join(self.directory, 'services.xml'), 'w') as services_file:
+            services_file.write(SERVICES)
+        core.parse_services_xml(os.path.join(self.directory, 'services.xml'), None)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def call(self, body, kind):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+
+        result = core.application(environ(path='/validated/', body=body, headers={'HTTP_X_KIND': kind}),
+                                  start_response)
+        return response['status'], ''.join(result)
+
+    def test_validate_in_a_case_stops_the_request(self):
+        status, body = self.call('{"extra": 1}', 'strict')
+        self.assertEqual(status, '400 Bad Request')
+        self.assertEqual(fields(json.loads(body)['errors']), ['body.extra', 'body.name'])
+        self.assertEqual(self.call('{"name": "a"}', 'strict'), ('201 Created', 'created'))
+        self.assertEqual(self.call('{"extra": 1}', 'lenient'), ('201 Created', 'created'))
+
+
+if __name__ == '__main__':
+    unittest.main()